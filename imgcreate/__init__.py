@@ -16,12 +16,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
-from imgcreate.live import *
-from imgcreate.creator import *
-from imgcreate.dnfinst import *
-from imgcreate.kickstart import *
-from imgcreate.fs import *
-from imgcreate.debug import *
+import importlib
 
 """A set of classes for building Fedora system images.
 
@@ -66,3 +61,51 @@ __all__ = (
     'construct_name',
     'setup_logging',
 )
+
+_EXPORTS = ('live', 'creator', 'dnfinst', 'kickstart', 'fs', 'debug')
+"""The modules whose names the package exports, in the order they used to
+be star-imported in, so that a name defined by several is taken from the
+last.  They are imported on first use, as live, creator, dnfinst and
+kickstart pull in dnf, rpm, selinux and pykickstart, which take seconds to
+load on a cold cache; tools that only need errors, fs or debug, or just
+print their --help, do not pay for them."""
+
+_NAMES = {
+    'CreatorError': 'errors',
+    'KickstartError': 'errors',
+    'MountError': 'errors',
+    'ImageCreator': 'creator',
+    'LoopImageCreator': 'creator',
+    'FSLABEL_MAXLEN': 'creator',
+    'CHECKPOINT_FILE': 'creator',
+    'LiveImageCreator': 'live',
+    'read_kickstart': 'kickstart',
+    'build_name': 'kickstart',
+    'RAM_STORAGE_MODES': 'fs',
+    'setup_logging': 'debug',
+}
+"""Where the commonly used names are defined, so that they are found
+without importing the modules searched before them."""
+
+def __getattr__(name):
+    if name.startswith('__'):
+        raise AttributeError("module 'imgcreate' has no attribute '%s'" % name)
+    if name in _NAMES:
+        value = getattr(importlib.import_module('imgcreate.' + _NAMES[name]),
+                        name)
+    else:
+        try:
+            return importlib.import_module('imgcreate.' + name)
+        except ModuleNotFoundError as e:
+            if e.name != 'imgcreate.' + name:
+                raise
+        for module in reversed(_EXPORTS):
+            module = importlib.import_module('imgcreate.' + module)
+            if not name.startswith('_') and hasattr(module, name):
+                value = getattr(module, name)
+                break
+        else:
+            raise AttributeError("module 'imgcreate' has no attribute '%s'" %
+                                 name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,651 @@
+#
+# bench.py : Offline benchmarks of image builds
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Benchmarks that need no network.
+
+  python -m imgcreate.bench build [options]
+
+generates a repository of synthetic packages in the work directory, or
+reuses the one left there by an earlier run with the same parameters, and
+builds a live image from it through a file:// repo: once to fill the
+package cache, then --runs times with cacheonly set.  The synthetic image
+is not bootable: the build stops short of configure(), which needs a shell
+and the usual system tools in the install root.
+
+  python -m imgcreate.bench fs [options]
+
+times the imgcreate.fs operations that editliveos and liveimage-mount
+chain together, for each filesystem type and image size.
+
+  python -m imgcreate.bench startup [options]
+
+times the start of the tools and of imports of the package, each in a new
+interpreter, and fails if one expected to be light loads dnf, rpm or
+another of HEAVY_MODULES.  It needs neither root nor a work directory.
+
+All print their timings and, with --output, write them as JSON, whose
+'timings' may be given back with --baseline to compare two versions.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+import logging
+import argparse
+
+from imgcreate.errors import *
+from imgcreate import metrics
+from imgcreate.debug import setup_logging
+from imgcreate.fs import *
+from imgcreate.util import run, call
+
+BUILD_PHASES = ('mount', 'install', 'download', 'transaction', 'unmount',
+                'package', 'resparse', 'squash', 'iso')
+"""The build phases timed by the build benchmark, see metrics.phase()."""
+
+SCRIPTLETS = ('post', 'pre', 'posttrans', 'pretrans')
+"""The install scriptlets given to the synthetic packages, in order of use.
+They are written in Lua, which rpm runs itself, so no shell is needed in
+the install root."""
+
+SPEC = """Name: %(name)s
+Version: 1
+Release: 1
+Summary: Synthetic package for imgcreate.bench
+License: GPL-2.0-only
+BuildArch: noarch
+%(requires)s
+%%description
+Synthetic package for imgcreate.bench.
+
+%%install
+%(install)s
+
+%(scriptlets)s
+%%files
+%(files)s
+"""
+
+HEAVY_MODULES = ('dnf', 'hawkey', 'rpm', 'selinux', 'pykickstart',
+                 'urlgrabber')
+"""Packages whose import takes seconds on a cold cache."""
+
+STARTUP_CASES = (
+    # (name, statement or tool arguments, whether it must stay light)
+    ('import imgcreate', 'import imgcreate', True),
+    ('import imgcreate.fs', 'import imgcreate.fs', True),
+    ('livecd-creator --help', ['livecd-creator', '--help'], True),
+    ('liveimage-reconstruct --help', ['liveimage-reconstruct', '--help'],
+     True),
+    ('livecd-iso-to-pxeboot --help', ['livecd-iso-to-pxeboot', '--help'],
+     True),
+    ('editliveos --help', ['editliveos', '--help'], False),
+    ('import imgcreate.live', 'import imgcreate.live', False),
+)
+
+# Run in a new interpreter to start a case, and print the heavy modules it
+# loaded.
+STARTUP_PROBE = """
+import sys, json, runpy
+case = json.loads(sys.argv[1])
+try:
+    if isinstance(case, list):
+        sys.argv = case
+        runpy.run_path(case[0], run_name='__main__')
+    else:
+        exec(case)
+except SystemExit:
+    pass
+print(json.dumps(sorted(m for m in sys.modules
+                        if m.split('.')[0] in %r)))
+""" % (HEAVY_MODULES,)
+
+KICKSTART = """part / --size %(size)d --fstype ext4
+selinux --disabled
+repo --name=bench --baseurl=%(url)s
+
+%%packages --nocore
+bench-base
+%%end
+"""
+
+def _payload(rng, size):
+    """Return size bytes of file content, half random and half repeated
+    text, which compresses about as well as a typical install."""
+    noise = size // 2
+    text = b'imgcreate.bench payload %d\n' % rng.getrandbits(32)
+    return (rng.getrandbits(noise * 8).to_bytes(noise, 'little') +
+            (text * (size // len(text) + 1))[:size - noise])
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def _parse_size(text):
+    """Return the bytes of a size such as '256M' or '16G'."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def _size_name(size):
+    if size % 1024 ** 3 == 0:
+        return '%dG' % (size // 1024 ** 3)
+    return '%dM' % (size // 1024 ** 2)
+
+
+class SyntheticRepo(object):
+    """A repository of generated noarch packages, bench-0000 and on, and of
+    bench-base, which requires them all.
+
+    packages   -- the number of packages, besides bench-base
+    files      -- the number of files in each package
+    file_size  -- the size of each file, in bytes
+    scriptlets -- the number of install scriptlets of each package
+    seed       -- the seed of the file contents
+    """
+    def __init__(self, path, packages=50, files=100, file_size=16384,
+                 scriptlets=1, seed=0):
+        self.path = os.path.abspath(path)
+        self.params = {'packages': packages, 'files': files,
+                       'file_size': file_size,
+                       'scriptlets': min(scriptlets, len(SCRIPTLETS)),
+                       'seed': seed}
+
+    @property
+    def url(self):
+        return 'file://' + os.path.join(self.path, 'repo')
+
+    @property
+    def payload_bytes(self):
+        p = self.params
+        return p['packages'] * p['files'] * p['file_size']
+
+    def __run(self, args):
+        try:
+            result = run(args, keep=20)
+        except OSError as e:
+            raise CreatorError("Cannot run %s: %s" % (args[0], e))
+        if result.returncode != 0:
+            raise CreatorError("%s failed:\n%s" % (args[0],
+                               result.err or result.out))
+
+    def __rpmbuild(self, name, payload=None, requires=()):
+        install = files = ''
+        if payload is not None:
+            install = ('mkdir -p %%{buildroot}/usr/share/bench\n'
+                       'cp -a %s %%{buildroot}/usr/share/bench/%s' %
+                       (payload, name))
+            files = '/usr/share/bench/%s' % name
+        scriptlets = ''.join('%%%s -p <lua>\nlocal n = 0\n'
+                             'for i = 1, 1000 do n = n + i end\n\n' % s
+                             for s in SCRIPTLETS[:self.params['scriptlets']])
+        spec = os.path.join(self.path, 'specs', name + '.spec')
+        with open(spec, 'w') as f:
+            f.write(SPEC % {'name': name,
+                            'requires': ''.join('Requires: %s\n' % r
+                                                for r in requires),
+                            'install': install,
+                            'scriptlets': scriptlets,
+                            'files': files})
+        self.__run(['rpmbuild', '-bb', '--quiet',
+                    '--define', '_topdir %s' % os.path.join(self.path,
+                                                            'rpmbuild'),
+                    '--define', '_rpmdir %s' % os.path.join(self.path,
+                                                            'repo'),
+                    '--define', '__os_install_post %{nil}',
+                    spec])
+
+    def build(self):
+        """Generate the repository, unless it already exists with the same
+        parameters, and return its URL."""
+
+        stamp = os.path.join(self.path, 'params.json')
+        try:
+            with open(stamp) as f:
+                if json.load(f) == self.params:
+                    return self.url
+        except (OSError, ValueError):
+            pass
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        for d in ('specs', 'payload', 'repo'):
+            makedirs(os.path.join(self.path, d))
+
+        t0 = time.monotonic()
+        rng = random.Random(self.params['seed'])
+        names = ['bench-%04d' % i for i in range(self.params['packages'])]
+        for name in names:
+            payload = os.path.join(self.path, 'payload', name)
+            makedirs(payload)
+            for i in range(self.params['files']):
+                with open(os.path.join(payload, 'f%05d' % i), 'wb') as f:
+                    f.write(_payload(rng, self.params['file_size']))
+            self.__rpmbuild(name, payload=payload)
+            shutil.rmtree(payload)
+        self.__rpmbuild('bench-base', requires=names)
+        self.__run(['createrepo_c', '--quiet',
+                    os.path.join(self.path, 'repo')])
+
+        with open(stamp, 'w') as f:
+            json.dump(self.params, f)
+        logging.info('Generated %s in %.1f seconds' %
+                     (self.url, time.monotonic() - t0))
+        return self.url
+
+
+def build_once(ks, workdir, cacheonly, compress_args):
+    """Build a live image from ks in workdir and return its timings."""
+
+    outdir = os.path.join(workdir, 'out')
+    shutil.rmtree(outdir, ignore_errors=True)
+    makedirs(outdir)
+
+    from imgcreate.live import LiveImageCreatorBase
+
+    exporter = metrics.open_exporter(os.path.join(workdir, 'metrics.prom'),
+                                     name='bench')
+    creator = LiveImageCreatorBase(ks, 'bench', fslabel='bench',
+                                   tmpdir=workdir, cacheonly=cacheonly)
+    creator.compress_args = compress_args
+    # Keep the synthetic builds out of the real size history.
+    creator.size_history = os.path.join(workdir, 'size-history.json')
+    success = False
+    t0 = time.monotonic()
+    try:
+        with metrics.phase('mount'):
+            creator.mount(None, os.path.join(workdir, 'cache'))
+        with metrics.phase('install'):
+            creator.install()
+        with metrics.phase('unmount'):
+            creator.unmount()
+        with metrics.phase('package'):
+            creator.package(outdir)
+        success = True
+    finally:
+        creator.cleanup()
+        metrics.close_exporter(success)
+
+    phases = {}
+    for phase in BUILD_PHASES:
+        value = exporter.get('phase_duration_seconds', phase=phase)
+        if value is not None:
+            phases[phase] = value
+    return {'cacheonly': cacheonly,
+            'total': time.monotonic() - t0,
+            'phases': phases,
+            'programs': dict((labels['program'], value) for labels, value in
+                             exporter.items('subprocess_seconds_total')),
+            'squash_ratio': exporter.get('squash_ratio'),
+            'iso_size_bytes': exporter.get('iso_size_bytes')}
+
+def bench_build(args):
+    from imgcreate import kickstart
+
+    workdir = os.path.abspath(args.workdir)
+    repo = SyntheticRepo(os.path.join(workdir, 'repo'),
+                         packages=args.packages, files=args.files,
+                         file_size=args.file_size,
+                         scriptlets=args.scriptlets, seed=args.seed)
+    url = repo.build()
+
+    size = args.image_size or repo.payload_bytes * 2 // 1024 ** 2 + 256
+    kscfg = os.path.join(workdir, 'bench.ks')
+    with open(kscfg, 'w') as f:
+        f.write(KICKSTART % {'size': size, 'url': url})
+    ks = kickstart.read_kickstart(kscfg)
+
+    # The first build fills the package cache that the others run from.
+    runs = []
+    for i in range(args.runs + 1):
+        result = build_once(ks, workdir, i > 0, args.compress)
+        runs.append(result)
+        print('%s build %d: %.1f s' % ('Cached' if i else 'Cold', i,
+                                       result['total']))
+        for phase in BUILD_PHASES:
+            if phase in result['phases']:
+                print('  %-12s %8.2f s' % (phase, result['phases'][phase]))
+
+    cached = runs[1:]
+    timings = dict((phase, _median([r['phases'][phase] for r in cached]))
+                   for phase in BUILD_PHASES
+                   if all(phase in r['phases'] for r in cached))
+    return {'benchmark': 'build',
+            'params': dict(repo.params, image_size=size,
+                           compress=args.compress),
+            'runs': runs,
+            'timings': timings}
+
+FSTYPES = ('ext4', 'xfs', 'btrfs', 'f2fs')
+"""The filesystem types timed by the fs benchmark, those ExtDiskMount can
+format and resizefs() can grow."""
+
+FS_SIZES = '256M,1G'
+
+FILL_BLOCK = 1024 ** 2
+
+def _fill(path, size, seed=0):
+    """Write about size bytes of files under path, from a few distinct
+    blocks so as not to wait on the random number generator."""
+    rng = random.Random(seed)
+    blocks = [_payload(rng, FILL_BLOCK) for i in range(16)]
+    for i in range(size // FILL_BLOCK):
+        if i % 256 == 0:
+            d = os.path.join(path, 'd%04d' % (i // 256))
+            makedirs(d)
+        with open(os.path.join(d, 'f%03d' % (i % 256)), 'wb') as f:
+            f.write(blocks[i % len(blocks)])
+    os.sync()
+
+class _Timer(object):
+    """Record the time taken by each operation of a benchmark case."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.timings = {}
+
+    def __call__(self, op, func, *args, **kwargs):
+        t0 = time.monotonic()
+        result = func(*args, **kwargs)
+        elapsed = time.monotonic() - t0
+        self.timings['%s/%s' % (self.prefix, op)] = elapsed
+        print('  %-12s %8.2f s' % (op, elapsed))
+        return result
+
+def bench_fs_case(workdir, fstype, size, fill):
+    """Time the imgcreate.fs operations on a new fstype image of size bytes,
+    filled to the fraction fill, and return their timings by
+    'fstype/size/operation'."""
+
+    casedir = tempfile.mkdtemp(prefix='fs-', dir=workdir)
+    timer = _Timer('%s/%s' % (fstype, _size_name(size)))
+    print('%s, %s:' % (fstype, _size_name(size)))
+    image = os.path.join(casedir, 'rootfs.img')
+    try:
+        disk = SparseLoopbackDisk(os.path.join(casedir, 'sparse.img'), size)
+        timer('create', disk.create)
+        disk.cleanup()
+        os.unlink(disk.lofile)
+
+        mnt = ExtDiskMount(SparseLoopbackDisk(image, size),
+                           os.path.join(casedir, 'mnt'), fstype, 4096,
+                           'bench')
+        timer('mount', mnt.mount)
+        _fill(mnt.mountdir, int(size * fill))
+        timer('unmount', mnt.cleanup)
+
+        mnt.disk.expand(size=size * 2)
+        timer('resizefs', resizefs, image, fstype, size * 2, blksz=4096)
+        if fstype.startswith('ext'):
+            timer('resparse', mnt.resparse, size)
+        mnt.cleanup()
+
+        snap = DeviceMapperSnapshot(LoopbackDisk(image, None, '-r'),
+                                    SparseLoopbackDisk(
+                                        os.path.join(casedir, 'cow.img'),
+                                        size // 4),
+                                    persistent='P')
+        try:
+            timer('snapshot', snap.create)
+            timer('snapshot-rm', snap.remove)
+        finally:
+            snap.remove(ignore_errors=True)
+            snap.cowloop.cleanup()
+            snap.imgloop.cleanup()
+
+        liveosdir = os.path.join(casedir, 'live', 'LiveOS')
+        makedirs(liveosdir)
+        os.rename(image, os.path.join(liveosdir, 'rootfs.img'))
+        live = LiveImageMount(os.path.dirname(liveosdir),
+                              os.path.join(casedir, 'livemnt'))
+        try:
+            timer('live-mount', live.mount)
+            # editliveos mirrors the mounted root image to a new one.
+            mt = config_mirror_targets(live.dm_target.DeviceMapperTarget__name,
+                                       casedir)
+            try:
+                if timer('mirror_fs', mirror_fs, *mt[:5]):
+                    dm_manager.remove(mt[4])
+            finally:
+                for target in mt[3]:
+                    target.cleanup()
+                if mt[5] is not None:
+                    mt[5].cleanup()
+            timer('live-umount', live.unmount)
+        finally:
+            live.cleanup()
+            os.rename(os.path.join(liveosdir, 'rootfs.img'), image)
+    finally:
+        shutil.rmtree(casedir, ignore_errors=True)
+    return timer.timings
+
+def bench_fs(args):
+    workdir = os.path.abspath(args.workdir)
+    makedirs(workdir)
+    # resizefs() mounts xfs and btrfs images there to grow them.
+    makedirs('/run/media')
+
+    sizes = [_parse_size(s) for s in args.sizes.split(',')]
+    fstypes = []
+    for fstype in args.fstypes.split(','):
+        if shutil.which('mkfs.' + fstype):
+            fstypes.append(fstype)
+        else:
+            logging.warning('mkfs.%s not found; skipping %s' %
+                            (fstype, fstype))
+
+    runs = []
+    for i in range(args.repeat):
+        timings = {}
+        for fstype in fstypes:
+            for size in sizes:
+                timings.update(bench_fs_case(workdir, fstype, size,
+                                             args.fill))
+        runs.append(timings)
+    return {'benchmark': 'fs',
+            'params': {'fstypes': fstypes, 'sizes': sizes,
+                       'fill': args.fill, 'repeat': args.repeat,
+                       'kernel': os.uname().release},
+            'runs': runs,
+            'timings': dict((key, _median([r[key] for r in runs]))
+                            for key in runs[0])}
+
+def _tools_dir():
+    tools = os.path.join(os.path.dirname(os.path.dirname(
+                                         os.path.abspath(__file__))), 'tools')
+    if os.path.isdir(tools):
+        return tools
+    return '/usr/bin'
+
+def startup_once(case, tools):
+    """Start case in a new interpreter, with its output discarded, and
+    return the time taken and the heavy modules it loaded."""
+    if isinstance(case, list):
+        case = [os.path.join(tools, case[0])] + case[1:]
+    env = dict(os.environ)
+    # Run the package being benchmarked, not one installed elsewhere.
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    t0 = time.monotonic()
+    p = subprocess.run([sys.executable, '-c', STARTUP_PROBE, json.dumps(case)],
+                       env=env, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.monotonic() - t0
+    if p.returncode != 0:
+        raise CreatorError(p.stderr.strip().splitlines()[-1]
+                           if p.stderr.strip() else 'exit %d' % p.returncode)
+    return elapsed, json.loads(p.stdout.strip().splitlines()[-1])
+
+def bench_startup(args):
+    tools = os.path.abspath(args.tools or _tools_dir())
+    runs = []
+    heavy = {}
+    failures = []
+    for i in range(args.repeat):
+        timings = {}
+        for name, case, light in STARTUP_CASES:
+            if isinstance(case, list) and not os.path.exists(
+                                        os.path.join(tools, case[0])):
+                continue
+            try:
+                elapsed, loaded = startup_once(case, tools)
+            except CreatorError as e:
+                logging.warning("Skipping '%s': %s" % (name, e))
+                continue
+            timings['startup/' + name] = elapsed
+            heavy[name] = loaded
+            if light and loaded and name not in failures:
+                failures.append(name)
+        runs.append(timings)
+
+    results = {'benchmark': 'startup',
+               'params': {'tools': tools, 'repeat': args.repeat,
+                          'python': sys.version.split()[0]},
+               'runs': runs,
+               'heavy_modules': heavy,
+               'failures': failures,
+               'timings': dict((key, _median([r[key] for r in runs
+                                              if key in r]))
+                               for key in runs[0])}
+    for key in sorted(results['timings']):
+        print('%-40s %8.3f s' % (key, results['timings'][key]))
+    for name in failures:
+        logging.error("'%s' loads %s" % (name, ', '.join(heavy[name])))
+    return results
+
+def compare(timings, baseline, threshold=0.1):
+    """Print each timing against the baseline timings, flagging those more
+    than threshold slower."""
+
+    print('%-40s %10s %10s %8s' % ('', 'baseline', 'now', 'change'))
+    for key in sorted(timings):
+        if key not in baseline:
+            continue
+        old, new = baseline[key], timings[key]
+        change = (new - old) / old if old else 0.0
+        print('%-40s %9.2fs %9.2fs %+7.1f%%%s' % (key, old, new, change * 100,
+              '  slower' if change > threshold else ''))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m imgcreate.bench',
+                                     description='Offline benchmarks')
+    setup_logging(parser)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workdir', default='/var/tmp/imgcreate-bench',
+                        help='Where the repositories and images are kept '
+                             '(default: %(default)s)')
+    common.add_argument('--output', metavar='FILE',
+                        help='Also write the results to FILE as JSON')
+    common.add_argument('--baseline', metavar='FILE',
+                        help='Compare the timings with those of an earlier '
+                             '--output FILE')
+    sub = parser.add_subparsers(dest='benchmark', metavar='BENCHMARK')
+    sub.required = True
+
+    p = sub.add_parser('build', parents=[common],
+                       help='Build live images from a synthetic repository')
+    p.set_defaults(func=bench_build)
+    p.add_argument('--packages', type=int, default=50,
+                   help='Number of synthetic packages (default: %(default)s)')
+    p.add_argument('--files', type=int, default=100,
+                   help='Files in each package (default: %(default)s)')
+    p.add_argument('--file-size', type=int, default=16384, metavar='BYTES',
+                   help='Size of each file (default: %(default)s)')
+    p.add_argument('--scriptlets', type=int, default=1,
+                   choices=range(len(SCRIPTLETS) + 1),
+                   help='Install scriptlets of each package '
+                        '(default: %(default)s)')
+    p.add_argument('--seed', type=int, default=0,
+                   help='Seed of the file contents (default: %(default)s)')
+    p.add_argument('--image-size', type=int, metavar='MB',
+                   help='Size of the root filesystem image (default: twice '
+                        'the payload plus 256 MB)')
+    p.add_argument('--compress', default='xz',
+                   help='mksquashfs compressor arguments (default: '
+                        '%(default)s)')
+    p.add_argument('--runs', type=int, default=3,
+                   help='Builds from the package cache, after the one that '
+                        'fills it (default: %(default)s)')
+
+    p = sub.add_parser('fs', parents=[common],
+                       help='Time the filesystem operations of imgcreate.fs')
+    p.set_defaults(func=bench_fs)
+    p.add_argument('--fstypes', default=','.join(FSTYPES),
+                   help='Comma separated filesystem types (default: '
+                        '%(default)s)')
+    p.add_argument('--sizes', default=FS_SIZES,
+                   help='Comma separated image sizes, from 256M to 16G '
+                        '(default: %(default)s)')
+    p.add_argument('--fill', type=float, default=0.25,
+                   help='Fraction of each image filled with files before it '
+                        'is resized, snapshotted and mirrored (default: '
+                        '%(default)s)')
+    p.add_argument('--repeat', type=int, default=1,
+                   help='Times each case is run; the median is kept '
+                        '(default: %(default)s)')
+
+    p = sub.add_parser('startup', parents=[common],
+                       help='Time the start of the tools and package imports')
+    p.set_defaults(func=bench_startup)
+    p.add_argument('--tools', metavar='DIR',
+                   help='Where the tools are (default: the tools directory '
+                        'of the source tree, or /usr/bin)')
+    p.add_argument('--repeat', type=int, default=5,
+                   help='Times each case is run; the median is kept '
+                        '(default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if args.benchmark == 'build' and args.runs < 1:
+        parser.error('--runs must be at least 1')
+    if args.benchmark in ('fs', 'startup') and args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    if args.benchmark == 'fs':
+        if not 0 <= args.fill < 0.9:
+            parser.error('--fill must be from 0 to 0.9')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.benchmark != 'startup' and os.geteuid() != 0:
+        print("You must run imgcreate.bench as root", file=sys.stderr)
+        return 1
+    try:
+        results = args.func(args)
+    except CreatorError as e:
+        logging.error("Benchmark failed: %s" % e)
+        return 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results['timings'], json.load(f).get('timings', {}))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if results.get('failures'):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
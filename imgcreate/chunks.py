@@ -0,0 +1,138 @@
+#
+# chunks.py : Chunk indexes for the delta distribution of images
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Chunk indexes of images, from which a client holding an older image
+fetches only the chunks that changed.
+
+With 'desync' or 'casync', an image is split into content-defined chunks,
+which are added to a chunk store shared by all the images, and described
+by a .caibx index written next to it.  With 'zsync', a .zsync control
+file is written instead, and the image itself is served as the store.
+reconstruct() rebuilds an image from its index, the store, and the older
+images given as seeds.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+
+from imgcreate.errors import *
+from imgcreate.util import call
+
+CHUNKERS = ('desync', 'casync', 'zsync')
+
+INDEX_SUFFIX = {'desync': '.caibx', 'casync': '.caibx', 'zsync': '.zsync'}
+
+INDEX_PROGRAM = {'desync': 'desync', 'casync': 'casync', 'zsync': 'zsyncmake'}
+
+def _require(program):
+    if not shutil.which(program):
+        raise CreatorError("%s is needed for chunk indexes, but is not "
+                           "installed" % program)
+
+def make_index(image, method, store=None, index=None):
+    """Write the chunk index of image with method, one of CHUNKERS, adding
+    its chunks to the store directory (desync and casync), and return the
+    index path, by default image plus the suffix of the method."""
+
+    if method not in CHUNKERS:
+        raise CreatorError("Unknown chunk index method '%s'" % method)
+    if index is None:
+        index = image + INDEX_SUFFIX[method]
+    _require(INDEX_PROGRAM[method])
+    if method == 'zsync':
+        # The image is fetched from beside the control file.
+        args = ['zsyncmake', '-o', index, '-u', os.path.basename(image),
+                image]
+    else:
+        if store is None:
+            raise CreatorError("A chunk store is needed for %s" % method)
+        os.makedirs(store, exist_ok=True)
+        if method == 'desync':
+            args = ['desync', 'make', '-s', store, index, image]
+        else:
+            args = ['casync', 'make', '--store=' + store, index, image]
+
+    logging.info('Writing the chunk index %s' % index)
+    if call(args) != 0:
+        raise CreatorError("Failed to write the chunk index of '%s'" % image)
+    return index
+
+def _desync_seeds(seeds, tmpdir):
+    """Return the .caibx indexes of the images in seeds, as desync extract
+    --seed wants, which reads each seed image from beside its index.  The
+    index written by make_index() next to an image is used if there is one;
+    otherwise the image is linked into tmpdir and indexed there."""
+
+    indexes = []
+    for n, seed in enumerate(seeds):
+        index = seed + INDEX_SUFFIX['desync']
+        if not os.path.isfile(index):
+            link = os.path.join(tmpdir, '%d-%s' % (n, os.path.basename(seed)))
+            os.symlink(os.path.abspath(seed), link)
+            index = link + INDEX_SUFFIX['desync']
+            logging.info('Indexing the seed %s' % seed)
+            if call(['desync', 'make', index, link]) != 0:
+                raise CreatorError("Failed to index the seed '%s'" % seed)
+        indexes.append(index)
+    return indexes
+
+def _run_reconstruct(args, index, output):
+    logging.info('Reconstructing %s from %s' % (output, index))
+    if call(args) != 0:
+        raise CreatorError("Failed to reconstruct '%s' from '%s'" %
+                           (output, index))
+
+def reconstruct(index, output, seeds=(), store=None, url=None):
+    """Rebuild the image of index in output, reusing the chunks of the
+    older images in seeds and fetching the others from store, a chunk store
+    directory or URL, or, for a .zsync index, from url or the location the
+    index names."""
+
+    if index.endswith('.zsync'):
+        _require('zsync')
+        args = ['zsync', '-o', output]
+        for seed in seeds:
+            args += ['-i', seed]
+        if url:
+            args += ['-u', url]
+        _run_reconstruct(args + [index], index, output)
+        return output
+
+    if store is None:
+        raise CreatorError("A chunk store is needed to reconstruct from "
+                           "'%s'" % index)
+    if not shutil.which('desync'):
+        _require('casync')
+        args = ['casync', 'extract', '--store=' + store]
+        for seed in seeds:
+            args.append('--seed=' + seed)
+        _run_reconstruct(args + [index, output], index, output)
+        return output
+
+    tmpdir = tempfile.mkdtemp(prefix='reconstruct-',
+                              dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        args = ['desync', 'extract', '-s', store]
+        for seed in _desync_seeds(seeds, tmpdir):
+            args += ['--seed', seed]
+        _run_reconstruct(args + [index, output], index, output)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return output
@@ -28,6 +28,7 @@ import os
 import os.path
 import stat
 import sys
+import json
 import tempfile
 import shutil
 import logging
@@ -41,10 +42,18 @@ from imgcreate.errors import *
 from imgcreate.fs import *
 from imgcreate.dnfinst import *
 from imgcreate import kickstart
+from imgcreate import metrics
+from imgcreate import planner
 
 FSLABEL_MAXLEN = 32
 """The maximum string length supported for LoopImageCreator.fslabel."""
 
+CHECKPOINT_PHASES = ('install', 'configure', 'squash', 'package')
+"""The build phases recorded by ImageCreator.checkpoint(), in order."""
+
+CHECKPOINT_FILE = 'checkpoint.json'
+"""The name of the checkpoint record in the build directory."""
+
 
 class ImageCreator(object):
     """Installs a system to a chroot directory.
@@ -95,8 +104,39 @@ class ImageCreator(object):
         self.docleanup = docleanup
         self.excludeWeakdeps = kickstart.exclude_weakdeps(self.ks)
 
+        self.checkpoints = False
+        """Controls whether completed build phases are recorded in the build
+        directory, which is then kept after a failure so that the build can
+        be continued with resume()."""
+
+        self.ephemeral_io = False
+        """Controls whether the install root is treated as throw-away while
+        packages are installed and %post scripts run: fsync() is suppressed
+        and, for loop images, the filesystem is formatted without a journal
+        and mounted without write barriers until it is packaged."""
+
+        self.size_check = True
+        """Controls whether the sizes of the image are predicted once the
+        packages are resolved, and the install aborted if the image or the
+        temporary directory is too small."""
+
+        self.size_history = planner.SIZE_HISTORY
+        """The file keeping the size ratios of earlier builds, on which the
+        predictions are based."""
+
+        self._size_plan = None
+        """The planner.SizePlan of the install, if sizes were checked."""
+
+        self.snapshot_dir = None
+        """A directory in which to record the installed packages, and the
+        repository metadata they came with, as local repositories from
+        which the build may be repeated."""
+
+        self.__phase = None
+        self.__saved_ld_preload = None
+        self.__cachedir = None
         self.__builddir = None
-        self.__bindmounts = []
+        self.__bindmounts = BindMountStack()
         self.__fstype = kickstart.get_image_fstype(self.ks, "ext4")
 
         self.__sanity_check()
@@ -213,6 +253,16 @@ class ImageCreator(object):
         """
         pass
 
+    def _release_instroot(self):
+        """Release any storage backing the install root.
+
+        This is called by cleanup() after the final unmount and before the
+        build directory is removed. The ImageCreator class holds no such
+        storage.
+
+        """
+        pass
+
     def _stage_final_image(self, ops=[]):
         """Stage the final system image in _outdir.
 
@@ -272,6 +322,80 @@ class ImageCreator(object):
         s += "sysfs      /sys      sysfs   defaults         0 0\n"
         return s
 
+    def __setup_nosync(self):
+        """Return the path inside the install root of its own fsync
+        suppressing library, or None if it has none.  The host's library is
+        not used, as it may need a newer glibc, or another architecture,
+        than the programs of the install root."""
+
+        shim = find_nosync_shim(self._instroot)
+        if shim is None:
+            logging.warning("No libeatmydata in the install root; fsync() is "
+                            "suppressed for rpm's own writes only")
+        return shim
+
+    def __preload_nosync(self, shim):
+        """Preload shim into the programs run in the install root, through
+        its /etc/ld.so.preload, until __remove_nosync()."""
+
+        path = self._instroot + "/etc/ld.so.preload"
+        makedirs(os.path.dirname(path))
+        self.__saved_ld_preload = ""
+        if os.path.exists(path):
+            with open(path) as f:
+                self.__saved_ld_preload = f.read()
+        with open(path, "w") as f:
+            f.write(self.__saved_ld_preload + shim + "\n")
+
+    def __remove_nosync(self):
+        if self.__saved_ld_preload is not None:
+            path = self._instroot + "/etc/ld.so.preload"
+            if self.__saved_ld_preload:
+                with open(path, "w") as f:
+                    f.write(self.__saved_ld_preload)
+            else:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            self.__saved_ld_preload = None
+
+    def _plan_sizes(self, plan):
+        """Fill in the space needed by the build.
+
+        This is the hook where subclasses add their images to the
+        planner.SizePlan made once the packages to install are known, by
+        setting its rootfs_limit and calling its need() method.
+
+        By default, the install root directory and the package cache are
+        accounted for.
+
+        """
+        if not os.path.ismount(self._instroot):
+            plan.need(self.__builddir, "install root", plan.growth())
+        plan.need(self.__cachedir, "package cache", plan.download)
+
+    def __check_sizes(self, pkgs):
+        installed = sum(p.installsize for p in pkgs)
+        download = sum(p.downloadsize for p in pkgs
+                       if not os.path.exists(p.localPkg()))
+        plan = planner.SizePlan(installed, download,
+                                planner.SizeHistory(self.size_history))
+
+        # Account for what an existing root, e.g. from base_on, already
+        # holds.
+        if os.path.ismount(self._instroot):
+            st = os.statvfs(self._instroot)
+            existing = (st.f_blocks - st.f_bfree) * st.f_frsize
+            plan.fresh = plan.fresh and existing < 64 * 1024 ** 2
+            plan.existing = existing
+            plan.rootfs += existing
+
+        self._plan_sizes(plan)
+        print(plan.report())
+        plan.check()
+        self._size_plan = plan
+
     def _get_post_scripts_env(self, in_chroot):
         """Return an environment dict for %post scripts.
 
@@ -338,8 +462,7 @@ class ImageCreator(object):
         filesystem.
 
         """
-        for b in self.__bindmounts:
-            b.mount()
+        self.__bindmounts.mount()
 
     def _undo_bindmounts(self):
         """Unmount the bind-mounted system directories from _instroot.
@@ -350,8 +473,7 @@ class ImageCreator(object):
         filesystem.
 
         """
-        for b in reversed(self.__bindmounts):
-            b.unmount()
+        self.__bindmounts.unmount()
 
     def _chroot(self):
         """Chroot into the install root.
@@ -440,6 +562,7 @@ class ImageCreator(object):
         except OSError as e:
             raise CreatorError("Failed create build directory in %s: %s" %
                                (self.tmpdir, e.strerror))
+        metrics.watch_dir(self.__builddir)
 
     def __sanity_check(self):
         """Ensure that the config we've been given is sane."""
@@ -544,6 +667,7 @@ class ImageCreator(object):
 
         cachesrc = cachedir or (self.__builddir + "/dnf-cache")
         makedirs(cachesrc)
+        self.__cachedir = cachesrc
 
         # delete any leftover @System.solv from a previous run from the cache,
         # which confuses Hawkey/DNF very badly (it thinks the rpmdb is corrupt
@@ -616,9 +740,113 @@ class ImageCreator(object):
 
         self.unmount()
 
+        if self.checkpoints and self.__phase in CHECKPOINT_PHASES[:-1]:
+            logging.warning("Keeping build directory %s after the '%s' "
+                            "checkpoint; continue with --resume %s" %
+                            (self.__builddir, self.__phase, self.__builddir))
+            self.__builddir = None
+            return
+
+        self._release_instroot()
         shutil.rmtree(self.__builddir, ignore_errors = True)
         self.__builddir = None
 
+    def _checkpoint_state(self):
+        """Return the instance state needed to resume after a checkpoint.
+
+        Subclasses extend the returned dict with their own state, which must
+        be JSON serializable, and restore it in _restore_checkpoint_state().
+
+        """
+        return {'name': self.name, 'ephemeral_io': self.ephemeral_io}
+
+    def _restore_checkpoint_state(self, state):
+        """Restore the state returned by _checkpoint_state()."""
+        self.name = state['name']
+        # An image formatted without a journal must still get it back.
+        self.ephemeral_io = state['ephemeral_io']
+
+    def _checkpoint_files(self):
+        """Return the files a checkpoint depends on.
+
+        Their sizes and modification times are recorded in the checkpoint
+        manifest and checked by resume().
+
+        """
+        return []
+
+    def checkpoint(self, phase):
+        """Record phase, one of CHECKPOINT_PHASES, as completed.
+
+        If checkpoints are enabled, the state of the build is written to the
+        build directory, from which resume() can later continue.
+
+        """
+        self.__phase = phase
+        if not self.checkpoints or not self.__builddir or \
+           phase == CHECKPOINT_PHASES[-1]:
+            return
+
+        os.sync()
+        manifest = {}
+        for path in self._checkpoint_files():
+            st = os.stat(path)
+            manifest[path] = [st.st_size, int(st.st_mtime)]
+        record = {'phase': phase,
+                  'state': self._checkpoint_state(),
+                  'manifest': manifest}
+
+        path = os.path.join(self.__builddir, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(record, f, indent=1)
+        os.replace(path + '.tmp', path)
+        logging.info("Saved checkpoint '%s' in %s" % (phase, path))
+
+    def checkpoint_reached(self, phase):
+        """Return True if phase was completed by this or a resumed build."""
+        if self.__phase is None:
+            return False
+        return (CHECKPOINT_PHASES.index(self.__phase) >=
+                CHECKPOINT_PHASES.index(phase))
+
+    def resume(self, builddir):
+        """Continue a build from the checkpoint saved in builddir.
+
+        The recorded state is restored and the files of the checkpoint
+        manifest are checked.  Returns the last completed phase; the caller
+        skips the phases for which checkpoint_reached() is True.
+
+        """
+        path = os.path.join(builddir, CHECKPOINT_FILE)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+            phase = record['phase']
+            CHECKPOINT_PHASES.index(phase)
+        except (IOError, ValueError, KeyError) as e:
+            raise CreatorError("No usable checkpoint in %s: %s" %
+                               (builddir, e))
+
+        for p, (size, mtime) in record['manifest'].items():
+            try:
+                st = os.stat(p)
+            except OSError:
+                raise CreatorError("Checkpoint file %s is missing; cannot "
+                                   "resume from %s" % (p, builddir))
+            if st.st_size != size or int(st.st_mtime) != mtime:
+                # Expected when the failed phase had already modified it.
+                logging.warning("%s has changed since the '%s' checkpoint" %
+                                (p, phase))
+
+        self.__builddir = os.path.abspath(builddir)
+        metrics.watch_dir(self.__builddir)
+        self.__phase = phase
+        self.checkpoints = True
+        self._restore_checkpoint_state(record['state'])
+        logging.info("Resuming the build in %s after '%s'" %
+                     (self.__builddir, phase))
+        return phase
+
     def __apply_selections(self, dbo):
         excludedPkgs = kickstart.get_excluded(self.ks, self._get_excluded_packages())
 
@@ -736,6 +964,14 @@ class ImageCreator(object):
         if kickstart.inst_langs(self.ks) != None:
             rpm.addMacro("_install_langs", kickstart.inst_langs(self.ks))
 
+        if self.ephemeral_io:
+            rpm.addMacro("_flush_io", "0")
+            # rpm runs the scriptlets chroot()ed, with the environment of
+            # this process, so the copy is preloaded from the install root.
+            shim = self.__setup_nosync()
+            if shim:
+                self.__preload_nosync(shim)
+
         dbo.fill_sack(load_system_repo = os.path.exists(self._instroot + "/var/lib/rpm/Packages"))
         dbo.read_comps()
         dbo.setModules(kickstart.get_modules(self.ks))
@@ -744,7 +980,10 @@ class ImageCreator(object):
             self.__apply_selections(dbo)
             if pkgverify_level:
                 dbo.setPkgVerifyLevel(pkgverify_level)
-            dbo.runInstall()
+            dbo.runInstall(check=self.__check_sizes if self.size_check
+                                 else None)
+            if self.snapshot_dir:
+                dbo.recordSnapshot(self.snapshot_dir)
         except (dnf.exceptions.DownloadError, dnf.exceptions.RepoError) as e:
             raise CreatorError("Unable to download from repo : %s" % (e,))
         except dnf.exceptions.Error as e:
@@ -752,6 +991,8 @@ class ImageCreator(object):
         finally:
             dbo.close()
             os.unlink(dnf_conf)
+            if self.ephemeral_io:
+                self.__remove_nosync()
 
         # do some clean up to avoid lvm info leakage.  this sucks.
         for subdir in ("cache", "backup", "archive"):
@@ -763,6 +1004,15 @@ class ImageCreator(object):
                 pass
 
     def _run_post_scripts(self):
+        shim = None
+        if self.ephemeral_io:
+            shim = self.__setup_nosync()
+        try:
+            self.__run_post_scripts(shim)
+        finally:
+            self.__remove_nosync()
+
+    def __run_post_scripts(self, shim):
         for s in kickstart.get_post_scripts(self.ks):
             (fd, path) = tempfile.mkstemp(prefix = "ks-script-",
                                           dir = self._instroot + "/tmp")
@@ -781,6 +1031,12 @@ class ImageCreator(object):
                 preexec = self._chroot
                 script = "/tmp/" + os.path.basename(path)
 
+            if self.ephemeral_io:
+                # Scripts run outside the install root use the host's own.
+                nosync = shim if s.inChroot else find_nosync_shim()
+                if nosync:
+                    env["LD_PRELOAD"] = nosync
+
             try:
                 subprocess.check_call([s.interp, script],
                                       preexec_fn = preexec, env = env)
@@ -825,10 +1081,21 @@ class ImageCreator(object):
         try:
             # Avoid relabelling host files.
             self.__destroy_selinuxfs()
-            self._undo_bindmounts()
+            self.__bindmounts.detach()
             kickstart.SelinuxConfig(self._instroot).apply(ksh.selinux)
         finally:
-            self._do_bindmounts()
+            self.__bindmounts.attach()
+
+        self.__record_rootfs_ratio()
+
+    def __record_rootfs_ratio(self):
+        # Only a fully installed and configured root measures the ratio.
+        plan = self._size_plan
+        if (plan is not None and plan.fresh and
+            os.path.ismount(self._instroot)):
+            st = os.statvfs(self._instroot)
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            plan.history.record('rootfs', used / plan.installed)
 
     def launch_shell(self, PS1='\\s-\\v\\$ '):
         """Launch a shell in the install root.
@@ -863,6 +1130,7 @@ class ImageCreator(object):
         for f in os.listdir(self._outdir):
             shutil.move(os.path.join(self._outdir, f),
                         os.path.join(destdir, f))
+        self.checkpoint('package')
 
     def create(self):
         """Install, configure and package an image.
@@ -872,11 +1140,16 @@ class ImageCreator(object):
         configure(), unmount and package().
 
         """
-        self.mount()
-        self.install()
-        self.configure()
-        self.unmount()
-        self.package()
+        with metrics.phase('mount'):
+            self.mount()
+        with metrics.phase('install'):
+            self.install()
+        with metrics.phase('configure'):
+            self.configure()
+        with metrics.phase('unmount'):
+            self.unmount()
+        with metrics.phase('package'):
+            self.package()
 
 class LoopImageCreator(ImageCreator):
     """Installs a system into a loopback-mountable filesystem image.
@@ -908,10 +1181,19 @@ class LoopImageCreator(ImageCreator):
 
         self.__instloop = None
         self.__imgdir = None
+        self.__ramstore = None
 
         self.__image_size = kickstart.get_image_size(self.ks,
                                                      4096 * 1024 * 1024)
 
+        self.ram_root = None
+        """Keep the install root image in RAM, on 'tmpfs' or 'zram', when it
+        fits ram_budget; otherwise it is kept under tmpdir."""
+
+        self.ram_budget = None
+        """Bytes of RAM the install root image may use; None allows half
+        of the available memory."""
+
     #
     # Properties
     #
@@ -994,22 +1276,103 @@ class LoopImageCreator(ImageCreator):
                 be used (or 4GiB if not specified in the kickstart).
 
         """
-        return self.__instloop.resparse(size)
+        with metrics.phase('resparse'):
+            if self.ephemeral_io:
+                # The image is kept from here on, so make it crash safe again.
+                self.__instloop.add_journal()
+                os.sync()
+            return self.__instloop.resparse(size)
+
+    def _plan_sizes(self, plan):
+        ImageCreator._plan_sizes(self, plan)
+        if self.__instloop is None:
+            return
+        # ext4 keeps 1% for root, and its metadata takes a few percent more.
+        plan.rootfs_limit = int(self.__image_size * 0.95)
+        if self.__ramstore is None:
+            plan.need(self.__imgdir, "root image", plan.growth())
 
     def _base_on(self, base_on):
         shutil.copy2(base_on, self._image)
     #
     # Actual implementation
     #
+    def _checkpoint_state(self):
+        state = ImageCreator._checkpoint_state(self)
+        state.update({'fslabel': self.__fslabel, 'imgdir': self.__imgdir,
+                      'image_size': self.__image_size,
+                      'blocksize': self.__blocksize})
+        return state
+
+    def _restore_checkpoint_state(self, state):
+        ImageCreator._restore_checkpoint_state(self, state)
+        self.__fslabel = state['fslabel']
+        self.__imgdir = state['imgdir']
+        self.__image_size = state['image_size']
+        self.__blocksize = state['blocksize']
+        if self.__imgdir and os.path.exists(self._image):
+            # Staging the final image works on an unmounted instloop.
+            self.__instloop = self.__new_instloop()
+
+    def _checkpoint_files(self):
+        files = ImageCreator._checkpoint_files(self)
+        if self.__imgdir and os.path.exists(self._image):
+            files.append(self._image)
+        return files
+
+    def __new_instloop(self):
+        ops = ''
+        if self.ephemeral_io:
+            ops = ephemeral_mount_ops(self._fstype)
+        return ExtDiskMount(SparseLoopbackDisk(self._image, self.__image_size,
+                                               role='rootfs',
+                                               blocksize=self.__blocksize),
+                            self._instroot,
+                            self._fstype,
+                            self.__blocksize,
+                            self.fslabel,
+                            ops=ops,
+                            journal=not self.ephemeral_io)
+
+    def _mount_ram_store(self, mountdir):
+        """Mount ram_root storage at mountdir, if the install root fits the
+        RAM budget; return True if it was mounted."""
+
+        if self.checkpoints:
+            # The store would not outlive a failed build, nor be released
+            # by the build resumed from its checkpoint.
+            logging.warning("Keeping the install root of a checkpointed "
+                            "build in %s, not in RAM" % self.tmpdir)
+            return False
+        available = mem_available()
+        budget = available // 2
+        if self.ram_budget:
+            budget = min(self.ram_budget, available)
+        # Allow for the filesystem metadata of the storage itself.
+        size = self.__image_size + 64 * 1024 ** 2
+        if size > budget:
+            logging.warning("The %d MiB install root exceeds the RAM "
+                            "budget of %d MiB; keeping it in %s" %
+                            (size // 1024 ** 2, budget // 1024 ** 2,
+                             self.tmpdir))
+            return False
+        try:
+            self.__ramstore = mount_ram_storage(self.ram_root, size, mountdir)
+        except MountError as e:
+            logging.warning("Could not set up %s storage, keeping the install "
+                            "root in %s: %s" % (self.ram_root, self.tmpdir, e))
+            return False
+        logging.info("Keeping the install root on %s (%d MiB)" %
+                     (self.ram_root, size // 1024 ** 2))
+        return True
+
     def _mount_instroot(self, base_on = None):
-        self.__imgdir = self._mkdtemp()
+        if self.__imgdir is None:
+            self.__imgdir = self._mkdtemp()
+            if self.ram_root:
+                self._mount_ram_store(self.__imgdir)
 
-        self.__instloop = ExtDiskMount(SparseLoopbackDisk(self._image,
-                                                          self.__image_size),
-                                       self._instroot,
-                                       self._fstype,
-                                       self.__blocksize,
-                                       self.fslabel)
+        self.__instloop = self.__new_instloop()
 
         if not base_on is None:
             self._base_on(base_on)
@@ -1024,6 +1387,11 @@ class LoopImageCreator(ImageCreator):
         if not self.__instloop is None:
             self.__instloop.cleanup()
 
+    def _release_instroot(self):
+        if self.__ramstore is not None:
+            self.__ramstore.cleanup()
+            self.__ramstore = None
+
     def _stage_final_image(self, ops=[]):
         self._resparse()
         shutil.move(self._image, self._outdir + "/" + self.name + ".img")
@@ -27,6 +27,11 @@ import glob
 import os
 import os.path
 import sys
+import json
+import gzip
+import lzma
+import errno
+import shutil
 import logging
 import itertools
 from urllib.parse import urljoin
@@ -43,6 +48,44 @@ import hawkey
 from pykickstart.constants import GROUP_DEFAULT, GROUP_REQUIRED, GROUP_ALL
 
 from imgcreate.errors import *
+from imgcreate.util import call
+from imgcreate import progress
+from imgcreate import metrics
+
+class EventDownloadProgress(DownloadProgress):
+    """The text-mode package download meter, also reporting the bytes
+    downloaded as 'download' progress events."""
+
+    files = 0
+    """The number of packages downloaded."""
+
+    downloaded = 0
+    """The number of bytes downloaded."""
+
+    def start(self, total_files, total_size, total_drpms=0):
+        DownloadProgress.start(self, total_files, total_size, total_drpms)
+        self.files = total_files
+        self.__total = total_size
+        self.__done = {}
+        self.__bytes = 0
+        progress.begin('download', total_size, files=total_files)
+
+    def progress(self, payload, done):
+        DownloadProgress.progress(self, payload, done)
+        self.__bytes += done - self.__done.get(payload, 0)
+        self.__done[payload] = done
+        self.downloaded = self.__bytes
+        progress.update('download', self.__bytes, self.__total)
+
+class EventTransactionProgress(TransactionProgress):
+    """The text-mode rpm transaction display, also reporting the packages
+    processed as 'transaction' progress events."""
+
+    def progress(self, package, action, ti_done, ti_total, ts_done, ts_total):
+        TransactionProgress.progress(self, package, action, ti_done, ti_total,
+                                     ts_done, ts_total)
+        progress.update('transaction', ts_done, ts_total,
+                        package=str(package))
 
 class DnfLiveCD(dnf.Base):
     def __init__(self, releasever=None, useplugins=False, pkgverify_level=None):
@@ -298,9 +341,13 @@ class DnfLiveCD(dnf.Base):
         if disabled:
             module_base.disable(disabled)
 
-    def runInstall(self):
+    def runInstall(self, check=None):
         """
         Install packages
+
+        check -- if given, called with the packages to install once the
+                 transaction is resolved, before anything is downloaded; it
+                 may raise an exception to abort the install
         """
         import dnf.exceptions
         os.environ["HOME"] = "/"
@@ -316,7 +363,21 @@ class DnfLiveCD(dnf.Base):
             return True
 
         dlpkgs = self.transaction.install_set
-        self.download_packages(dlpkgs, DownloadProgress())
+        if check is not None:
+            check(dlpkgs)
+
+        meter = EventDownloadProgress()
+        with metrics.phase('download'):
+            self.download_packages(dlpkgs, meter)
+        progress.end('download')
+        # Packages not downloaded were read from the cache or a local repo.
+        metrics.inc('download_bytes_total', meter.downloaded)
+        metrics.set_value('packages', len(dlpkgs) - meter.files,
+                          source='cache')
+        metrics.set_value('packages', meter.files, source='download')
+        if dlpkgs:
+            metrics.set_value('cache_hit_ratio',
+                              1 - meter.files / len(dlpkgs))
 
         # check gpg signatures (repo must be gpgcheck=1)
         #   We auto-import all dnf repository keys as we
@@ -336,7 +397,101 @@ class DnfLiveCD(dnf.Base):
         if self.pkgverify_level:
             rpm.addMacro("_pkgverify_level", self.pkgverify_level)
 
-        ret = self.do_transaction(TransactionProgress())
+        progress.begin('transaction', len(dlpkgs), unit='packages')
+        with metrics.phase('transaction'):
+            ret = self.do_transaction(EventTransactionProgress())
+        progress.end('transaction')
         print("")
         self._cleanupRpmdbLocks(self.conf.installroot)
         return ret
+
+    def recordSnapshot(self, path):
+        """
+        Record the resolved transaction as a local repository snapshot in
+        path, after runInstall().
+
+        Each enabled repository gets a directory named after its id, with
+        the packages of the transaction it provided, new repodata carrying
+        over its comps and modules metadata, and a copy of the original
+        repodata in 'upstream-repodata'.  path/snapshot.repo configures
+        them all for --repo, and path/packages.json lists the packages.
+        """
+        pkgs = self.transaction.install_set if self.transaction else []
+        byrepo = dict((repo.id, []) for repo in self.repos.iter_enabled())
+        for pkg in pkgs:
+            byrepo.setdefault(pkg.reponame, []).append(pkg)
+
+        manifest = []
+        repofile = []
+        for repo in self.repos.iter_enabled():
+            repodir = os.path.join(os.path.abspath(path), repo.id)
+            pkgdir = os.path.join(repodir, 'Packages')
+            shutil.rmtree(repodir, ignore_errors=True)
+            os.makedirs(pkgdir)
+
+            for pkg in byrepo[repo.id]:
+                dst = os.path.join(pkgdir, os.path.basename(pkg.location))
+                try:
+                    os.link(pkg.localPkg(), dst)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM):
+                        raise
+                    shutil.copy2(pkg.localPkg(), dst)
+                idtype, digest = pkg.returnIdSum()
+                manifest.append({'nevra': str(pkg), 'repo': repo.id,
+                                 'file': os.path.relpath(dst, path),
+                                 idtype: digest})
+
+            upstream = repo.get_metadata_path('primary')
+            if upstream:
+                shutil.copytree(os.path.dirname(upstream),
+                                os.path.join(repodir, 'upstream-repodata'))
+
+            args = ['createrepo_c', '--quiet']
+            comps = self.__snapshotMetadata(repo, ('group', 'group_gz',
+                                                   'group_xz'),
+                                            os.path.join(repodir, 'comps.xml'))
+            if comps:
+                args += ['--groupfile', comps]
+            if call(args + [repodir]) != 0:
+                raise CreatorError("Failed to create the repodata of the "
+                                   "'%s' snapshot in %s" % (repo.id, repodir))
+            modules = self.__snapshotMetadata(repo, ('modules',),
+                                              os.path.join(repodir,
+                                                           'modules.yaml'))
+            if modules and call(['modifyrepo_c', '--mdtype=modules', modules,
+                                 os.path.join(repodir, 'repodata')]) != 0:
+                raise CreatorError("Failed to add the modules metadata to "
+                                   "the '%s' snapshot" % repo.id)
+
+            repofile.append('[%s]\nname=%s (snapshot)\nbaseurl=file://%s\n'
+                            'gpgcheck=%d\n' % (repo.id, repo.name, repodir,
+                                               repo.gpgcheck))
+            if repo.gpgkey:
+                repofile.append('gpgkey=%s\n' % ' '.join(repo.gpgkey))
+            repofile.append('\n')
+
+        with open(os.path.join(path, 'snapshot.repo'), 'w') as f:
+            f.write(''.join(repofile))
+        with open(os.path.join(path, 'packages.json'), 'w') as f:
+            json.dump(sorted(manifest, key=lambda p: p['nevra']), f, indent=1)
+        logging.info('Recorded %d packages from %d repositories in %s',
+                     len(manifest), len(byrepo), path)
+
+    def __snapshotMetadata(self, repo, mdtypes, dst):
+        # Write the first of mdtypes the repo has to dst, uncompressed.
+        for mdtype in mdtypes:
+            src = repo.get_metadata_path(mdtype)
+            if not src:
+                continue
+            opener = open
+            if src.endswith('.gz'):
+                opener = gzip.open
+            elif src.endswith('.xz'):
+                opener = lzma.open
+            elif not src.endswith(('.xml', '.yaml')):
+                continue
+            with opener(src, 'rb') as fin, open(dst, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            return dst
+        return None
@@ -24,7 +24,10 @@ import os.path
 import sys
 import errno
 import stat
+import glob
+import ctypes
 import shutil
+import struct
 import subprocess
 import random
 import resource
@@ -34,6 +37,8 @@ import time
 
 from imgcreate.util import *
 from imgcreate.errors import *
+from imgcreate import progress
+from imgcreate import metrics
 
 umount_fail_fmt = ("Unable to unmount filesystem at %s. The process using the "
                    "imgcreate module, or one of the libraries used by that "
@@ -82,22 +87,20 @@ def squashfs_compression_type(sqfs_img):
     env['LC_ALL'] = 'C'
     args = ['unsquashfs', '-s', sqfs_img]
     try:
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, env=env)
-        out, err = p.communicate()
+        result = run(args, env=env, keep=None, log=None)
     except OSError as e:
         raise SquashfsError(u"Error white stat-ing '%s'\n'%s'" % (args, e))
     except:
         raise SquashfsError(u"Error while stat-ing '%s'" % args)
     else:
-        if p.returncode != 0:
+        if result.returncode != 0:
             raise SquashfsError(
                 u"Error while stat-ing '%s'\n'%s'\nreturncode: '%s'" %
-                (args, err.decode('utf-8'), p.returncode))
+                (args, result.err, result.returncode))
         else:
             compress_type = 'undetermined'
-            for l in out.splitlines():
-                if l.split(None, 1)[0] == b'Compression':
+            for l in result.out.splitlines():
+                if l.split(None, 1)[:1] == ['Compression']:
                     compress_type = l.split()[1]
                     break
     return compress_type
@@ -114,19 +117,103 @@ def mksquashfs(in_dir, out_img, compress_args, ops=[]):
     if not sys.stdout.isatty():
         args.append('-no-progress')
 
-    if ops or '-progress' in args:
-        if 'show-squashing' in ops:
-            ops.remove('show-squashing')
-        args += ops
-        p = subprocess.Popen(args, stdout=None, stderr=subprocess.STDOUT)
-        p.wait()
-        ret = p.returncode
-    else:
-        ret = call(args)
+    in_bytes = None
+    if metrics.exporter is not None:
+        if os.path.isdir(in_dir):
+            in_bytes = metrics.disk_usage(in_dir)
+        else:
+            in_bytes = os.stat(in_dir).st_blocks * 512
+    t0 = time.monotonic()
+    # The compressed size is not known ahead, so only bytes written and
+    # the rate are reported.
+    with progress.FileGrowth('squash', out_img, src=in_dir):
+        if ops or '-progress' in args:
+            if 'show-squashing' in ops:
+                ops.remove('show-squashing')
+            args += ops
+            p = subprocess.Popen(args, stdout=None, stderr=subprocess.STDOUT)
+            p.wait()
+            ret = p.returncode
+        else:
+            ret = call(args)
 
     if ret != 0:
         raise SquashfsError("'%s' exited with error (%d)" %
                             (' '.join(args), ret))
+    if in_bytes:
+        out_bytes = os.stat(out_img).st_size
+        metrics.set_value('squash_input_bytes', in_bytes)
+        metrics.set_value('squash_output_bytes', out_bytes)
+        metrics.set_value('squash_ratio', out_bytes / in_bytes)
+        metrics.set_value('squash_throughput_bytes_per_second',
+                          in_bytes / max(time.monotonic() - t0, 1e-6))
+
+def _squashfs_file_order(in_dir):
+    """Return (relative path, size) for the regular files in in_dir in the
+    order mksquashfs stores their data by default: a depth-first walk with
+    the entries of each directory sorted by name.
+    """
+    order = []
+
+    def _scan(d, rel):
+        try:
+            entries = sorted(os.listdir(d))
+        except OSError:
+            return
+        for e in entries:
+            path = os.path.join(d, e)
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                _scan(path, os.path.join(rel, e))
+            elif stat.S_ISREG(st.st_mode):
+                order.append((os.path.join(rel, e), st.st_size))
+
+    _scan(in_dir, '')
+    return order
+
+def _estimate_seeks(reads, layout):
+    """Count the reads that do not continue where the previous one ended
+    in layout, and the total distance jumped, for files read in order."""
+
+    offsets = {}
+    pos = 0
+    for path, size in layout:
+        offsets[path] = (pos, size)
+        pos += size
+    seeks, distance, head = 0, 0, 0
+    for path in reads:
+        start, size = offsets[path]
+        if start != head:
+            seeks += 1
+            distance += abs(start - head)
+        head = start + size
+    return seeks, distance
+
+def squashfs_sort_file(profile, in_dir, sort_file):
+    """Write a mksquashfs -sort file that places the files listed in a read
+    profile (paths relative to in_dir, in first-read order) ahead of all
+    others, in that order.  Return the number of profiled files found and
+    the estimated (seeks, distance) of the profiled reads before and after.
+    """
+    with open(profile) as f:
+        reads = [l.strip().lstrip(os.sep) for l in f if l.strip()]
+    layout = _squashfs_file_order(in_dir)
+    present = set(p for p, size in layout)
+    # The sort file format cannot express whitespace in a path.
+    reads = [p for p in dict.fromkeys(reads)
+             if p in present and not any(c.isspace() for c in p)]
+
+    # mksquashfs priorities are signed 16 bit; higher is stored first.
+    with open(sort_file, 'w') as f:
+        for i, path in enumerate(reads):
+            f.write('%s %d\n' % (path, max(32767 - i, -32768)))
+
+    hot = set(reads)
+    sizes = dict(layout)
+    sorted_layout = [(p, sizes[p]) for p in reads]
+    sorted_layout += [(p, size) for p, size in layout if p not in hot]
+    return (len(reads), _estimate_seeks(reads, layout),
+            _estimate_seeks(reads, sorted_layout))
 
 def checkfsblksz(fstype, size, use=None, fssize=None):
 
@@ -191,6 +278,13 @@ def checkfsblksz(fstype, size, use=None, fssize=None):
             16 KiB is the default; 32 KiB is allowed; 64 KiB is the maximum.
             ''' % size)
 
+    elif fstype in ('', 'temp', 'DM_snapshot_cow'):
+        if size % 512 or not check_chunksize(size // 512):
+            raise CreatorError('''\n
+            ERROR: < %s > is not a valid Device-mapper snapshot chunk size.
+            Powers of 2 from 4096 to 1048576 bytes may be specified.\n\n'''
+            % size)
+
 
 def resizefs(fs, fstype, size=None, blksz=None, minimal=False, ops=''):
 
@@ -477,9 +571,137 @@ def config_mirror_targets(src_fs, tmpdir='/tmp', legs=2, ops=None):
     imgsize //= 512
     return imgdev, dm_node, imgsize, target_objs, mirname, loopobj
 
-def mirror_fs(fs_dev, dm_node, imgsize, mirloops, mirname):
+def _print_copy_progress(label, done, total, t0, phase=None):
+    """Print an in-place progress line with throughput and remaining time,
+    and report it as a progress event of phase."""
+
+    if phase:
+        progress.update(phase, done, total)
+
+    elapsed = time.time() - t0
+    rate = done / elapsed if elapsed > 0 else 0
+    if rate and total > done:
+        eta = '%d:%02d' % divmod(int((total - done) / rate), 60)
+    else:
+        eta = '--:--'
+    percent = 100.0 * done / total if total else 100.0
+    print('\r  {0} {1:5.1f} % complete, {2:8.1f} MiB/s, ETA {3}  '.format(
+          label, percent, rate / 1024 ** 2, eta), end='')
+    sys.stdout.flush()
+
+def copy_image(src, dst, size=None, workers=4, chunksize=64 * 1024 ** 2):
+    """Copy an unmounted image file or block device to the file dst.
+
+    Fixed-size extents are copied by a pool of threads with copy_file_range(2),
+    so that the kernel may share or offload the blocks, and holes in a sparse
+    source are skipped to keep dst sparse.  Where copy_file_range is refused
+    (block devices, older kernels), the extent is copied with pread/pwrite.
+    """
+    import concurrent.futures
+    import threading
+
+    sfd = os.open(src, os.O_RDONLY)
+    try:
+        if size is None:
+            size = os.lseek(sfd, 0, os.SEEK_END)
+        dfd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o644)
+    except OSError:
+        os.close(sfd)
+        raise
+    copied = [0]
+    lock = threading.Lock()
+
+    def _account(n):
+        with lock:
+            copied[0] += n
+
+    def _copy_range(off, end):
+        use_cfr = hasattr(os, 'copy_file_range')
+        while off < end:
+            n = 0
+            if use_cfr:
+                try:
+                    n = os.copy_file_range(sfd, dfd, end - off, off, off)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                       errno.EOPNOTSUPP):
+                        raise
+                    use_cfr = False
+                    continue
+            else:
+                buf = os.pread(sfd, min(end - off, 1024 ** 2), off)
+                n = len(buf) and os.pwrite(dfd, buf, off)
+            if n == 0:
+                break
+            off += n
+            _account(n)
+
+    def _copy_extent(start, end):
+        pos = start
+        while pos < end:
+            try:
+                data = os.lseek(sfd, pos, os.SEEK_DATA)
+                hole = min(os.lseek(sfd, data, os.SEEK_HOLE), end)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # No more data in the file.
+                    break
+                data, hole = pos, end
+            if data >= end:
+                break
+            _account(data - pos)
+            _copy_range(data, hole)
+            pos = hole
+        _account(end - pos)
+
+    logging.info('copying %s to %s with %d workers' % (src, dst, workers))
+    t0 = time.time()
+    progress.begin('copy', size, src=src, dst=dst)
+    try:
+        os.ftruncate(dfd, size)
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            jobs = [pool.submit(_copy_extent, off, min(off + chunksize, size))
+                    for off in range(0, size, chunksize)]
+            pending = jobs
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=1)
+                _print_copy_progress('Copying', copied[0], size, t0, 'copy')
+            [j.result() for j in jobs]
+        os.fsync(dfd)
+    except OSError as e:
+        raise MountError("Failed to copy '%s' to '%s': %s" % (src, dst, e))
+    finally:
+        os.close(dfd)
+        os.close(sfd)
+    _print_copy_progress('Copying', size, size, t0)
+    progress.end('copy', size)
+    print()
+    logging.info('copied %d bytes in %.1f s' % (size, time.time() - t0))
+
+def _dm_event_nr(name):
+    """Return the current event counter of a Device-mapper device."""
+
+    return int(rcall(['dmsetup', 'info', '-c', '--noheadings', '-o', 'events',
+                      name])[0].strip() or 0)
+
+def mirror_fs(fs_dev, dm_node, imgsize, mirloops, mirname, interval=1.0):
     """Use Device Mapper to mirror a registered filesystem or block device to
-    a pre-configured extensible disk mount or a cryptoLUKS code object."""
+    a pre-configured extensible disk mount or a cryptoLUKS code object.
+
+    When the source is neither a Device-mapper node nor mounted and the
+    targets are plain loop files, no mirror is needed, and the image is copied
+    directly with copy_image().  Returns True if a mirror device named mirname
+    was created, which the caller must remove.
+    """
+    if (dm_node is None and not isinstance(mirloops[0].disk, CryptoLUKSDevice)
+        and not findmnt('-no TARGET', fs_dev)):
+        src = losetup('-nO BACK-FILE', fs_dev) or fs_dev
+        print('  Copying filesystem %s to %s.' % (src, mirname))
+        for obj in mirloops:
+            copy_image(src, obj.disk.lofile, imgsize * 512)
+            LoopbackDisk.create(obj.disk)
+            obj.created = True
+        return False
 
     dmsetup_cmd = ['dmsetup']
     if '--noudevsync' in rcall(['dmsetup', '-h'])[1]:
@@ -505,30 +727,167 @@ def mirror_fs(fs_dev, dm_node, imgsize, mirloops, mirname):
     # Loading mirror configuration.
     logging.info('loading mirror %s to %s' % (device, repr(tgtloops)))
 
+    # The mirror is addressed by name below, so there is no need to wait for
+    # its /dev/mapper node.
     call(dmsetup_cmd + ['create', mirname, '--readonly', '--table', mirror])
-    time.sleep(2)
 
+    # dm-raid1 raises a table event when region recovery completes, so
+    # 'dmsetup wait' returns as soon as the copy is in sync.  The timeout
+    # only paces the progress reports.
     print('  Copying filesystem %s to %s.' % (device, mirname))
-    while 'waiting':
-        num, denom = rcall(['dmsetup', 'status', mirname]
-                           )[0].split()[-5].split('/')
-        if num == denom: break
-        percent = 100.0 * int(num) / int(denom)
-        print('\r  Mirroring  {0:4.1f} % complete. '.format(percent),
-              '\b|\b', end='')
-        sys.stdout.flush()
-        time.sleep(.5)
-        print('/\b', end='')
-        sys.stdout.flush()
-        time.sleep(.5)
-        print('\u2014\b', end='')
-        sys.stdout.flush()
-        time.sleep(.5)
-        print('\\\b', end='')
-        sys.stdout.flush()
-        time.sleep(.5)
-    print('\r  Mirroring 100 % complete.   ')
+    total = imgsize * 512
+    t0 = time.time()
+    progress.begin('mirror', total, src=device, dst=mirname)
+    while 'copying':
+        event_nr = _dm_event_nr(mirname)
+        status = rcall(['dmsetup', 'status', mirname])[0].split()
+        num, denom = status[-5].split('/')
+        if 'D' in status[-3]:
+            raise MountError("Mirror leg failure on '%s': %s" %
+                             (mirname, ' '.join(status)))
+        _print_copy_progress('Mirroring', total * int(num) // int(denom),
+                             total, t0, 'mirror')
+        if num == denom:
+            break
+        dm_manager.wait_event(mirname, event_nr, interval)
+    progress.end('mirror', total)
+    print()
+    logging.info('mirrored %d bytes in %.1f s' % (total, time.time() - t0))
     sys.stdout.flush()
+    return True
+
+
+def _same_content(a, b, bufsize=1024 ** 2):
+    if os.path.samefile(a, b):
+        return True
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            da, db = fa.read(bufsize), fb.read(bufsize)
+            if da != db:
+                return False
+            if not da:
+                return True
+
+def stage_file(src, dst):
+    """Place src at dst for an image staging tree, as cheaply as possible:
+    a hard link, else a reflink (FICLONE) on filesystems that share
+    extents, else a copy.  A dst already holding the same content is kept,
+    so boot files shared by several bootloader configurations are written
+    once.  Return how the file was staged.
+    """
+    import fcntl
+
+    if os.path.exists(dst):
+        if _same_content(src, dst):
+            return 'kept'
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return 'linked'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    FICLONE = 0x40049409
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            how = 'reflinked'
+        except OSError:
+            shutil.copyfileobj(s, d, 1024 ** 2)
+            how = 'copied'
+    shutil.copystat(src, dst)
+    return how
+
+OVERLAY_ALLOC_MODES = ('sparse', 'fallocate', 'zeroed')
+
+SNAPSHOT_CHUNK_SECTORS = 8
+"""Default Device-mapper snapshot chunk size in 512-byte sectors (4 KiB),
+the size dracut uses when it activates a new overlay."""
+
+SNAPSHOT_MAGIC = 0x70416e53
+"""Magic number of a persistent Device-mapper snapshot store header."""
+
+def check_chunksize(chunksize):
+    """Return True if chunksize, in sectors, is a power of 2 from 4 KiB to
+    1 MiB, as accepted for a snapshot overlay."""
+    return (isinstance(chunksize, int) and 8 <= chunksize <= 2048 and
+            not chunksize & (chunksize - 1))
+
+def allocate_file(path, size, alloc='sparse', dirmode=None):
+    """Grow the file at path to size bytes, creating it if needed.
+
+    'sparse' only sets the file length; 'fallocate' reserves zeroed extents
+    with fallocate --zero-range (falling back to a plain fallocate, then to
+    'zeroed', where the filesystem lacks support); 'zeroed' writes zeros.
+    Bytes below the current end of file are left untouched.
+    """
+    if alloc not in OVERLAY_ALLOC_MODES:
+        raise CreatorError("Unknown allocation mode '%s', expected one of %s"
+                           % (alloc, ', '.join(OVERLAY_ALLOC_MODES)))
+    makedirs(os.path.dirname(path), dirmode)
+    t0 = time.time()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        start = os.fstat(fd).st_size
+        if size <= start:
+            return
+        if alloc == 'fallocate':
+            for args in (['fallocate', '--zero-range'], ['fallocate']):
+                if call(args + ['-o', str(start), '-l', str(size - start),
+                                path]) == 0:
+                    break
+            else:
+                logging.info('fallocate unsupported for %s, zeroing' % path)
+                alloc = 'zeroed'
+        if alloc == 'zeroed':
+            zeros = bytes(4 * 1024 ** 2)
+            offset = start
+            while offset < size:
+                offset += os.pwrite(fd, zeros[:size - offset], offset)
+        elif alloc == 'sparse':
+            os.ftruncate(fd, size)
+        if alloc != 'sparse':
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    logging.info('Allocated %s from %d to %d bytes (%s) in %.2f s' %
+                 (path, start, size, alloc, time.time() - t0))
+
+def wipe_header(path, length=64 * 1024):
+    """Zero the leading length bytes of a file or device, such as the
+    Device-mapper snapshot header of an overlay, without touching the rest.
+    """
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, bytes(length), 0)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot_header(path, chunksize=SNAPSHOT_CHUNK_SECTORS):
+    """Format path as an empty persistent Device-mapper snapshot store with
+    a chunk size of chunksize sectors.
+
+    The kernel takes the chunk size of an existing store from its header in
+    preference to the one in the snapshot table, so an overlay formatted
+    here keeps its chunk size when it is activated by dracut at boot.
+    """
+    if not check_chunksize(chunksize):
+        raise SnapshotError('Invalid snapshot chunk size: %s sectors' %
+                            chunksize)
+    header = struct.pack('<4I', SNAPSHOT_MAGIC, 1, 1, chunksize)
+    chunk = chunksize * 512
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        # The header chunk, then an empty first exception area.
+        os.pwrite(fd, header + bytes(chunk - len(header)), 0)
+        os.pwrite(fd, bytes(chunk), chunk)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 class LoopbackMount:
@@ -558,11 +917,9 @@ class LoopbackMount:
         if self.losetup:
             return
 
-        losetupProc = subprocess.Popen(['losetup', '-f'],
-                                       stdout=subprocess.PIPE)
-        losetupOutput = losetupProc.communicate()[0]
+        losetupOutput, err, rc = rcall(['losetup', '-f'], raise_err=False)
 
-        if losetupProc.returncode:
+        if rc != 0:
             raise MountError("Failed to allocate loop device for '%s'" %
                              self.lofile)
 
@@ -683,14 +1040,62 @@ class RawDisk(Disk):
         return True
 
 
+LOOP_ROLES = {
+    # The build root image: its pages are already cached by the filesystem
+    # on top, so bypass the host page cache for the backing file.
+    'rootfs': {'direct_io': True, 'read_ahead_kb': 512, 'scheduler': 'none'},
+    # A read-only squashfs or root image source, mostly read sequentially.
+    'source': {'direct_io': True, 'read_ahead_kb': 1024, 'scheduler': 'none'},
+    # A copy-on-write overlay, written and read in small random chunks.
+    'cow': {'direct_io': True, 'read_ahead_kb': 64, 'scheduler': 'none'},
+}
+"""Loop device settings applied by LoopbackDisk for each role."""
+
+def tune_loop(device, direct_io=False, read_ahead_kb=None, scheduler=None):
+    """Apply direct I/O and block queue settings to an attached loop device.
+
+    Direct I/O is only switched on where the backing file supports it
+    (tmpfs or isofs do not, for example); otherwise the device silently
+    keeps using buffered I/O.  Return whether direct I/O is in use.
+    """
+    sysdir = os.path.join('/sys/block', os.path.basename(device))
+    if direct_io and call(['losetup', '--direct-io=on', device]) != 0:
+        logging.info('%s keeps buffered I/O; its backing file does not '
+                     'support direct I/O' % device)
+    for attr, value in (('read_ahead_kb', read_ahead_kb),
+                        ('scheduler', scheduler)):
+        if value is None:
+            continue
+        try:
+            with open(os.path.join(sysdir, 'queue', attr), 'w') as f:
+                f.write(str(value))
+        except OSError as e:
+            logging.debug('Could not set %s of %s: %s' % (attr, device, e))
+    try:
+        with open(os.path.join(sysdir, 'loop', 'dio')) as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return False
+
+
 class LoopbackDisk(Disk):
-    """A Disk backed by a file via the loop module."""
-    def __init__(self, lofile, size, ops='', fstype=None, dirmode=None):
+    """A Disk backed by a file via the loop module.
+
+    role selects the LOOP_ROLES settings applied once the device is set up,
+    and blocksize, if given, the logical block size of the device, which
+    should match the block size of the filesystem it holds.
+    """
+    def __init__(self, lofile, size, ops='', fstype=None, dirmode=None,
+                 role=None, blocksize=None):
         Disk.__init__(self, size)
         self.lofile = lofile
         self.ops = ops
         self.fstype = fstype
         self.dirmode = dirmode
+        self.role = role
+        self.blocksize = blocksize
+        self.direct_io = False
+        """Whether the attached device uses direct I/O."""
 
     def fixed(self):
         return False
@@ -702,15 +1107,13 @@ class LoopbackDisk(Disk):
         if self.device is not None:
             return
 
-        losetupProc = subprocess.Popen(['losetup', '-f'],
-                                       stdout=subprocess.PIPE)
-        losetupOutput = losetupProc.communicate()[0]
+        losetupOutput, err, rc = rcall(['losetup', '-f'], raise_err=False)
 
-        if losetupProc.returncode:
+        if rc != 0:
             raise MountError("Failed to allocate loop device for '%s'" %
                              self.lofile)
 
-        device = losetupOutput.split()[0].decode('utf-8')
+        device = losetupOutput.split()[0]
         args = ['losetup', device, self.lofile]
         if not ops:
             ops = self.ops
@@ -720,11 +1123,23 @@ class LoopbackDisk(Disk):
             args += ['-r']
 
         logging.info("Losetup add %s mapping to %s"  % (device, self.lofile))
-        rc = call(args)
+        rc = 1
+        if self.blocksize and self.blocksize != 512:
+            rc = call(args[:1] + ['--sector-size', str(self.blocksize)] +
+                      args[1:])
+            if rc != 0:
+                logging.info("Could not give %s a %d byte logical block "
+                             "size" % (device, self.blocksize))
+        if rc != 0:
+            rc = call(args)
         if rc != 0:
             raise MountError("Failed to allocate loop device for '%s'" %
                              self.lofile)
         self.device = device
+        if self.role:
+            self.direct_io = tune_loop(device, **LOOP_ROLES[self.role])
+            logging.info("Tuned %s as a %s loop device (direct I/O: %s)" %
+                         (device, self.role, self.direct_io))
         call(['udevadm', 'settle'])
         self.fstype = rcall([
             'blkid', '-o', 'value', '-s', 'TYPE', device])[0].strip()
@@ -738,29 +1153,30 @@ class LoopbackDisk(Disk):
 
 
 class SparseLoopbackDisk(LoopbackDisk):
-    """A Disk backed by a sparse file via the loop module."""
-    def __init__(self, lofile, size, ops='', dirmode=None):
-        LoopbackDisk.__init__(self, lofile, size, ops=ops, dirmode=dirmode)
-
-    def expand(self, create=False, size=None, dirmode=None):
-        flags = os.O_WRONLY
-        if create:
-            flags |= os.O_CREAT
-            if dirmode is None:
-                dirmode = self.dirmode
-            makedirs(os.path.dirname(self.lofile), dirmode)
+    """A Disk backed by a sparse file via the loop module.
 
+    alloc selects how the file is grown, one of OVERLAY_ALLOC_MODES.
+    """
+    def __init__(self, lofile, size, ops='', dirmode=None, alloc='sparse',
+                 role=None, blocksize=None):
+        LoopbackDisk.__init__(self, lofile, size, ops=ops, dirmode=dirmode,
+                              role=role, blocksize=blocksize)
+        self.alloc = alloc
+
+    def expand(self, create=False, size=None, dirmode=None, alloc=None):
+        if not create and not os.path.exists(self.lofile):
+            raise MountError("Cannot expand missing file '%s'" % self.lofile)
+        if dirmode is None:
+            dirmode = self.dirmode
         if size is None:
             size = self.size
+        if alloc is None:
+            alloc = self.alloc
 
-        logging.info("Extending sparse file %s to %d" % (self.lofile, size))
-        fd = os.open(self.lofile, flags)
-
+        logging.info("Extending %s file %s to %d" % (alloc, self.lofile, size))
         if size <= 0:
             size = 1
-        os.lseek(fd, size-1, 0)
-        os.write(fd, b'\x00')
-        os.close(fd)
+        allocate_file(self.lofile, size, alloc, dirmode)
 
     def truncate(self, size=None):
         if size is None:
@@ -779,14 +1195,74 @@ class SparseLoopbackDisk(LoopbackDisk):
 class ExistingSparseLoopbackDisk(SparseLoopbackDisk):
     """Don't expand the disk on creation."""
 
-    def __init__(self, lofile, size, ops='', dirmode=None):
+    def __init__(self, lofile, size, ops='', dirmode=None, role=None,
+                 blocksize=None):
         SparseLoopbackDisk.__init__(self, lofile, size, ops=ops,
-                                    dirmode=dirmode)
+                                    dirmode=dirmode, role=role,
+                                    blocksize=blocksize)
 
     def create(self, ops='', dirmode=None):
         LoopbackDisk.create(self, ops=ops)
 
 
+class ZramDisk(Disk):
+    """A Disk backed by a compressed RAM block device of the zram module,
+    managed through /sys/class/zram-control."""
+    def __init__(self, size, algorithm='zstd'):
+        Disk.__init__(self, size)
+        self.algorithm = algorithm
+        self.__num = None
+
+    def fixed(self):
+        return True
+
+    def exists(self):
+        return self.device is not None
+
+    def create(self, ops=''):
+        if self.device is not None:
+            return
+        if not os.path.exists('/sys/class/zram-control'):
+            try:
+                call(['modprobe', 'zram'])
+            except OSError:
+                pass
+        try:
+            with open('/sys/class/zram-control/hot_add') as f:
+                self.__num = int(f.read())
+            sysdir = '/sys/block/zram%d' % self.__num
+            try:
+                with open(sysdir + '/comp_algorithm', 'w') as f:
+                    f.write(self.algorithm)
+            except OSError:
+                logging.warning('zram does not support %s compression; '
+                                'using its default' % self.algorithm)
+            with open(sysdir + '/disksize', 'w') as f:
+                f.write(str(self.size))
+        except (OSError, ValueError) as e:
+            self.cleanup()
+            raise MountError('Failed to allocate a %d byte zram device: %s' %
+                             (self.size, e))
+        self.device = '/dev/zram%d' % self.__num
+        logging.info('Allocated zram device %s of %d bytes' %
+                     (self.device, self.size))
+
+    def cleanup(self):
+        if self.__num is None:
+            return
+        logging.info('Removing zram device %d' % self.__num)
+        try:
+            with open('/sys/block/zram%d/reset' % self.__num, 'w') as f:
+                f.write('1')
+            with open('/sys/class/zram-control/hot_remove', 'w') as f:
+                f.write(str(self.__num))
+        except OSError as e:
+            logging.warning('Failed to remove zram device %d: %s' %
+                            (self.__num, e))
+        self.__num = None
+        self.device = None
+
+
 class Mount:
     """A generic base class to deal with mounting things."""
     def __init__(self, mountdir):
@@ -891,6 +1367,82 @@ class DiskMount(Mount):
                              (remount_ops, self.disk.device, self.mountdir))
 
 
+NOSYNC_SHIMS = ('/usr/lib64/libeatmydata.so', '/usr/lib/libeatmydata.so',
+                '/usr/lib/*-linux-gnu/libeatmydata.so',
+                '/usr/lib/*-linux-gnu/libeatmydata/libeatmydata.so')
+"""Where to look for an LD_PRELOAD library that turns fsync() and friends
+into no-ops."""
+
+def find_nosync_shim(root='/'):
+    """Return the path, as seen from root, of the fsync suppressing
+    LD_PRELOAD library installed in root, or None if there is none."""
+
+    for pattern in NOSYNC_SHIMS:
+        for path in sorted(glob.glob(os.path.join(root, pattern[1:]))):
+            # Follow links inside root, not on the host.
+            rel = os.path.join('/', os.path.relpath(path, root))
+            for i in range(40):
+                if not os.path.islink(path):
+                    break
+                rel = os.path.normpath(os.path.join(os.path.dirname(rel),
+                                                    os.readlink(path)))
+                path = os.path.join(root, rel[1:])
+            if os.path.isfile(path):
+                return rel
+    return None
+
+def ephemeral_mount_ops(fstype):
+    """Return the mount options for a throw-away build filesystem, which
+    need not survive a crash: no write barriers and lazy timestamps."""
+
+    if fstype.startswith('ext'):
+        return 'nobarrier,lazytime'
+    # XFS and F2FS dropped the nobarrier option.
+    return 'lazytime'
+
+
+RAM_STORAGE_MODES = ('tmpfs', 'zram')
+
+def mem_available():
+    """Return the memory available for new allocations, in bytes."""
+
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def mount_ram_storage(mode, size, mountdir):
+    """Mount size bytes of RAM-backed storage at mountdir and return its
+    DiskMount, whose cleanup() releases the memory.
+
+    mode is one of RAM_STORAGE_MODES: 'tmpfs' allocates pages as files are
+    written; 'zram' holds a journal-less ext4 filesystem, mounted with
+    discard so that deleted files return their memory, on a compressed zram
+    device.
+    """
+    if mode == 'tmpfs':
+        ramfs = DiskMount(RawDisk(size, 'tmpfs'), mountdir, 'tmpfs',
+                          ops='size=%d,mode=0755' % size)
+    elif mode == 'zram':
+        disk = ZramDisk(size)
+        disk.create()
+        if call(['mkfs.ext4', '-q', '-m', '0', '-O', '^has_journal',
+                 disk.device]) != 0:
+            disk.cleanup()
+            raise MountError('Failed to make a filesystem on %s' %
+                             disk.device)
+        ramfs = DiskMount(disk, mountdir, 'ext4', ops='discard')
+    else:
+        raise MountError("Unknown RAM storage mode '%s'" % mode)
+    try:
+        ramfs.mount()
+    except MountError:
+        ramfs.cleanup()
+        raise
+    return ramfs
+
+
 class OverlayFSMount(Mount):
     """An OverlayFS mount that can modify its overlay."""
     def __init__(self, name, lower, upper=None, work=None, dest=None,
@@ -1007,13 +1559,49 @@ class OverlayFSMount(Mount):
         self.created = False
 
 
+MS_RDONLY = 0x1
+MS_REMOUNT = 0x20
+MS_BIND = 0x1000
+MNT_DETACH = 0x2
+AT_FDCWD = -100
+AT_RECURSIVE = 0x8000
+OPEN_TREE_CLONE = 0x1
+MOVE_MOUNT_F_EMPTY_PATH = 0x4
+
+SYS_OPEN_TREE = 428
+SYS_MOVE_MOUNT = 429
+"""System call numbers of open_tree(2) and move_mount(2), the same on all
+the architectures built for (Linux 5.2 or later)."""
+
+_libc = None
+
+def _libc_call(func, *args):
+    """Call the C library function func, returning its result, or raising
+    OSError with the errno it set; AttributeError if it is missing."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    ret = getattr(_libc, func)(*args)
+    if ret < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return ret
+
+def _path(path):
+    return os.fsencode(path) if path is not None else None
+
 class BindChrootMount():
-    """Represents a bind mount of a directory or file into a chroot."""
+    """Represents a bind mount of a directory or file into a chroot.
+
+    It is mounted with mount(2), or the mount binary where that fails, and
+    may be detached from the chroot and attached back, submounts included,
+    with open_tree(2) and move_mount(2) where the kernel has them."""
     def __init__(self, src, chroot, dest=None, ops='', dirmode=None):
         self.src = src
         self.root = chroot
         self.ops = ops
         self.dirmode = dirmode
+        self.__tree = None
 
         if not dest:
             dest = src
@@ -1026,6 +1614,9 @@ class BindChrootMount():
     def mount(self, ops='', dirmode=None):
         if self.mounted:
             return
+        if self.__tree is not None:
+            self.attach()
+            return
 
         if dirmode is None:
             dirmode = self.dirmode
@@ -1037,23 +1628,38 @@ class BindChrootMount():
                 open(self.dest, 'a').close()
             else:
                 return
-        args = ['mount', '--bind', self.src, self.dest]
-        rc = call(args)
-        if rc != 0:
-            raise MountError("Bind-mounting '%s' to '%s' failed" %
-                             (self.src, self.dest))
+        try:
+            _libc_call('mount', _path(self.src), _path(self.dest), None,
+                       MS_BIND, None)
+        except (OSError, AttributeError) as e:
+            logging.debug("mount(2) of '%s' failed: %s" % (self.dest, e))
+            args = ['mount', '--bind', self.src, self.dest]
+            rc = call(args)
+            if rc != 0:
+                raise MountError("Bind-mounting '%s' to '%s' failed" %
+                                 (self.src, self.dest))
+        # It is mounted now, whether or not the remount succeeds.
+        self.mounted = True
         if not ops:
             ops = self.ops
         if '-r' in ops or 'ro' in ops:
             self.remount('ro')
 
-        self.mounted = True
-
     def remount(self, ops):
         if not self.mounted or not os.path.ismount(self.dest):
             self.mounted = False
             return
 
+        if ops in ('ro', 'rw'):
+            flags = MS_REMOUNT | MS_BIND
+            if ops == 'ro':
+                flags |= MS_RDONLY
+            try:
+                _libc_call('mount', None, _path(self.dest), None, flags, None)
+                return
+            except (OSError, AttributeError) as e:
+                logging.debug("mount(2) remount of '%s' failed: %s" %
+                              (self.dest, e))
         remount_ops = ''.join(('remount,', ops))
         args = ['mount', '-o', remount_ops, self.dest]
         rc = call(args)
@@ -1062,16 +1668,102 @@ class BindChrootMount():
                              (remount_ops, self.src, self.dest))
 
     def unmount(self):
+        if self.__tree is not None:
+            # Dropping the last reference unmounts a detached tree.
+            os.close(self.__tree)
+            self.__tree = None
         if not self.mounted or not os.path.ismount(self.dest):
             self.mounted = False
             return
 
-        rc = call(['umount', '-R', self.dest])
-        if rc != 0:
-            call(['umount', '-l', self.dest])
+        try:
+            _libc_call('umount2', _path(self.dest), 0)
+        except (OSError, AttributeError) as e:
+            # Busy, or with submounts: let umount -R sort them out.
+            logging.debug("umount2(2) of '%s' failed: %s" % (self.dest, e))
+            rc = call(['umount', '-R', self.dest])
+            if rc != 0:
+                call(['umount', '-l', self.dest])
+                raise MountError(umount_fail_fmt % self.dest)
+        self.mounted = False
+
+    def detach(self):
+        """Take the mount, with any mounted under it, off the chroot, and
+        keep it for attach().  Without open_tree(2), it is unmounted."""
+        if not self.mounted or not os.path.ismount(self.dest):
+            self.mounted = False
+            return
+
+        try:
+            tree = _libc_call('syscall', SYS_OPEN_TREE, AT_FDCWD,
+                              _path(self.dest), OPEN_TREE_CLONE |
+                              os.O_CLOEXEC | AT_RECURSIVE)
+        except (OSError, AttributeError) as e:
+            logging.debug("open_tree(2) of '%s' failed: %s" % (self.dest, e))
+            self.unmount()
+            return
+        try:
+            _libc_call('umount2', _path(self.dest), MNT_DETACH)
+        except OSError:
+            os.close(tree)
             raise MountError(umount_fail_fmt % self.dest)
+        self.__tree = tree
         self.mounted = False
 
+    def attach(self):
+        """Put a mount taken off by detach() back, or mount it again."""
+        if self.mounted:
+            return
+        if self.__tree is None:
+            self.mount()
+            return
+
+        tree, self.__tree = self.__tree, None
+        try:
+            _libc_call('syscall', SYS_MOVE_MOUNT, tree, b'', AT_FDCWD,
+                       _path(self.dest), MOVE_MOUNT_F_EMPTY_PATH)
+        except OSError as e:
+            logging.debug("move_mount(2) to '%s' failed: %s" % (self.dest, e))
+            os.close(tree)
+            self.mount()
+            return
+        os.close(tree)
+        self.mounted = True
+
+    def cleanup(self):
+        self.unmount()
+
+
+class BindMountStack(list):
+    """The BindChrootMounts of a chroot, mounted in order and unmounted in
+    reverse order."""
+
+    def mount(self):
+        for b in self:
+            b.mount()
+
+    def unmount(self):
+        for b in reversed(self):
+            b.unmount()
+
+    def detach(self):
+        """Detach all the mounts from the chroot, to attach() them back
+        later without mounting them again.  If one fails, those already
+        detached are attached back before the error is raised."""
+        done = []
+        try:
+            for b in reversed(self):
+                b.detach()
+                done.append(b)
+        except:
+            for b in reversed(done):
+                b.attach()
+            raise
+
+    def attach(self):
+        for b in self:
+            b.attach()
+
     def cleanup(self):
         self.unmount()
 
@@ -1081,12 +1773,15 @@ class ExtDiskMount(DiskMount):
     btrfs, and F2FS filesystems. (xfs and F2FS can only be enlarged.)
     """
     def __init__(self, disk, mountdir, fstype, blocksize, fslabel,
-                 rmmountdir=True, ops='', dirmode=None):
+                 rmmountdir=True, ops='', dirmode=None, journal=True):
         DiskMount.__init__(self, disk, mountdir, fstype, rmmountdir, ops=ops,
                            dirmode=dirmode)
         self.blocksize = blocksize
         self.fslabel = '_' + fslabel
         self.created = False
+        self.journal = journal
+        """Whether a new ext3/4 filesystem is formatted with a journal; one
+        formatted without may be given one later with add_journal()."""
 
     def __format_filesystem(self):
         logging.info("Formating %s filesystem on %s" % (self.fstype,
@@ -1096,6 +1791,8 @@ class ExtDiskMount(DiskMount):
         if self.fstype.startswith('ext'):
             args += ['-F', '-L', self.fslabel[0:16], '-m', '1', '-b',
                      str(self.blocksize)]
+            if not self.journal:
+                args += ['-O', '^has_journal']
         elif self.fstype == 'xfs':
             args += ['-L', self.fslabel[0:12], '-b', 'size=%s' %
                      str(self.blocksize)]
@@ -1156,19 +1853,35 @@ class ExtDiskMount(DiskMount):
         self.__create(ops)
         DiskMount.mount(self, ops, dirmode)
 
+    def add_journal(self):
+        """Give an ext3/4 filesystem formatted without a journal its journal
+        back; the filesystem should not be mounted."""
+
+        if self.fstype not in ('ext3', 'ext4'):
+            return
+        out = rcall(['dumpe2fs', '-h', self.disk.lofile], raise_err=False)[0]
+        for line in out.splitlines():
+            if (line.startswith('Filesystem features:') and
+                'has_journal' in line.split()):
+                return
+        logging.info('Adding a journal to %s' % self.disk.lofile)
+        if call(['tune2fs', '-O', 'has_journal', self.disk.lofile]) != 0:
+            raise MountError("Failed to add a journal to '%s'" %
+                             self.disk.lofile)
+        self.journal = True
+
     def __fsck(self, fstype):
         return fsck(self.disk.lofile, self.fstype)
         return rc
 
     def __get_size_from_filesystem(self):
         def parse_field(output, field):
-            for line in output.split(b'\n'):
+            for line in output.split('\n'):
                 if line.startswith(field):
                     return line[len(field):].strip()
 
             raise KeyError("Failed to find field '%s' in output" % field)
 
-        dev_null = os.open('/dev/null', os.O_WRONLY)
         if self.fstype.startswith('ext'):
             args = ['dumpe2fs', '-h']
         elif self.fstype == 'f2fs':
@@ -1181,24 +1894,19 @@ class ExtDiskMount(DiskMount):
 
         if not self.fstype == 'btrfs':
             args += [self.disk.lofile]
-        try:
-            out = subprocess.Popen(args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=dev_null).communicate()[0]
-        finally:
-            os.close(dev_null)
+        out = run(args, keep=None, log=None).out
 
         if self.fstype.startswith('ext'):
-            return int(parse_field(out, b'Block count:')) * self.blocksize
+            return int(parse_field(out, 'Block count:')) * self.blocksize
         elif self.fstype == 'f2fs':
-            args = parse_field(out, b'Info: total FS sectors = ')
+            args = parse_field(out, 'Info: total FS sectors = ')
             return int(args.split()[0]) * 512
         elif self.fstype == 'xfs':
-            args = parse_field(out, b'data     =                       bsize=')
-            return int(args.split()[0]) * int(args.split(b'=')[1].split(b',')[0])
+            args = parse_field(out, 'data     =                       bsize=')
+            return int(args.split()[0]) * int(args.split('=')[1].split(',')[0])
         elif self.fstype == 'btrfs':
             self.unmount()
-            return int(parse_field(out, b'    Device size:'))
+            return int(parse_field(out, '    Device size:'))
 
     def __resize_to_minimal(self, ops=''):
         resizefs(self.disk.lofile, self.fstype, minimal=True, ops=ops)
@@ -1217,6 +1925,103 @@ class ExtDiskMount(DiskMount):
         return minsize
 
 
+class DeviceMapperManager(object):
+    """Create and remove Device-mapper targets in step with udev.
+
+    dmsetup, when built with udev synchronization, blocks on a udev cookie
+    until the rules for a created or removed node have run, so no settling
+    delay is needed once it returns.  A removal can still find the device
+    busy while a udev worker (blkid, the inotify watch rule) holds it open
+    briefly after the last unmount; the udev queue is settled first, and an
+    EBUSY failure is retried with bounded exponential backoff.
+
+    Every wait is recorded in waits as (operation, name, seconds, attempts).
+    """
+    def __init__(self, retries=8, backoff=0.05, max_backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.waits = []
+
+    def record(self, op, name, seconds, attempts=1):
+        self.waits.append((op, name, seconds, attempts))
+        logging.debug('dm %s %s: waited %.3f s, %d attempt(s)' %
+                      (op, name, seconds, attempts))
+
+    def wait_total(self):
+        """Return the seconds spent waiting on Device-mapper so far."""
+        return sum(w[2] for w in self.waits)
+
+    def settle(self, name=None, timeout=10):
+        """Wait for the udev event queue to drain, if udev is running."""
+
+        if not os.path.exists('/run/udev/control'):
+            return
+        t0 = time.time()
+        try:
+            call(['udevadm', 'settle', '--timeout=%d' % timeout])
+        except OSError:
+            return
+        self.record('settle', name, time.time() - t0)
+
+    def __run(self, op, name, args):
+        delay = self.backoff
+        t0 = time.time()
+        for attempt in range(1, self.retries + 1):
+            out, err, rc = rcall(args, raise_err=False)
+            for buf in (out + err).splitlines():
+                logging.debug('%s', buf)
+            if rc == 0 or 'busy' not in err.lower() or attempt == self.retries:
+                break
+            logging.info('dm %s %s: device busy, retrying in %.2f s' %
+                         (op, name, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+        self.record(op, name, time.time() - t0, attempt)
+        return rc
+
+    def create(self, name, table, readonly=False):
+        """Create the target name from table; return the dmsetup exit code.
+        dmsetup returns once udev has created /dev/mapper/name.
+        """
+        args = ['dmsetup', 'create', name, '-vv', '--verifyudev',
+                '--uuid', 'LIVECD-%s' % name, '--table', table]
+        if readonly:
+            args += ['--readonly']
+        rc = self.__run('create', name, args)
+        if rc != 0:
+            # Let udev release the backing devices before they are detached.
+            self.settle(name)
+        return rc
+
+    def remove(self, name):
+        """Remove the target name; return the dmsetup exit code."""
+
+        self.settle(name)
+        return self.__run('remove', name, ['dmsetup', 'remove', name])
+
+    def wait_event(self, name, event_nr, timeout):
+        """Wait up to timeout seconds for an event on the target name beyond
+        event_nr; return True if one arrived."""
+
+        t0 = time.time()
+        waiter = subprocess.Popen(['dmsetup', 'wait', name, str(event_nr)],
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            waiter.wait(timeout=timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            waiter.kill()
+            waiter.wait()
+            return False
+        finally:
+            self.record('wait', name, time.time() - t0)
+
+dm_manager = DeviceMapperManager()
+"""The DeviceMapperManager shared by the Device-mapper target classes."""
+
+
 class DeviceMapperLinear(object):
     def __init__(self, imgloop, ops=''):
         self.imgloop = imgloop    # A LoopbackDisk object
@@ -1244,19 +2049,14 @@ class DeviceMapperLinear(object):
 
         table = '0 %d linear %s 0' % (size // 512, self.imgloop.device)
 
-        args = ['dmsetup', 'create', self.__name, '-vv', '--verifyudev',
-                '--uuid', 'LIVECD-%s' % self.__name, '--table', table]
-
         if not ops:
             ops = self.ops
-        if '--readonly' in ops or '-r' in ops or 'ro' in ops:
-            args += ['--readonly']
+        readonly = '--readonly' in ops or '-r' in ops or 'ro' in ops
 
-        if call(args) != 0:
-            time.sleep(1)
+        if dm_manager.create(self.__name, table, readonly) != 0:
             self.imgloop.cleanup()
-            raise SnapshotError('Could not create snapshot device using: ' +
-                                ' '.join(args))
+            raise SnapshotError('Could not create dm-linear device %s using '
+                                'table: %s' % (self.__name, table))
         self.__created = True
         self.device = os.path.join('/dev/mapper', self.__name)
 
@@ -1267,9 +2067,7 @@ class DeviceMapperLinear(object):
         if not self.__created:
             return
 
-        # sleep to try to avoid any dm shenanigans
-        time.sleep(2)
-        rc = call(['dmsetup', 'remove', self.__name])
+        rc = dm_manager.remove(self.__name)
         if not ignore_errors and rc != 0:
             raise SnapshotError('Could not remove dm-linear device.')
 
@@ -1279,12 +2077,60 @@ class DeviceMapperLinear(object):
         self.imgloop.cleanup()
 
 
+def snapshot_status(name):
+    """Return the status of the snapshot or snapshot-merge target name.
+
+    dmsetup status on a snapshot returns, e.g.,
+      "0 8388608 snapshot 416/1048576 260"
+    following the pattern:
+      "A B snapshot C/D E"
+    where C is the number of 512 byte sectors allocated in the overlay,
+          D          "        "    "     "   of the overlay,
+      and E          "        "    "     "   holding metadata;
+          A is the start sector and B the size of the device in sectors.
+    Older kernels omit E.  An unusable snapshot reports a single word
+    instead of C/D E: Invalid, Overflow, Merge failed, or Unknown.
+
+    The result is a dict with 'target', 'state' ('valid' or the reported
+    word), and 'allocated', 'total' and 'metadata' sector counts.
+    """
+    out, err, rc = rcall(['dmsetup', 'status', name], raise_err=False)
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) > 3 and fields[2] in ('snapshot', 'snapshot-merge'):
+            break
+    else:
+        raise SnapshotError("No snapshot status for '%s': %s" %
+                            (name, (out + err).strip()))
+    status = {'target': fields[2], 'state': 'valid',
+              'allocated': 0, 'total': 0, 'metadata': 0}
+    usage = fields[3].split('/')
+    try:
+        if len(usage) != 2:
+            raise ValueError
+        status['allocated'], status['total'] = int(usage[0]), int(usage[1])
+        if len(fields) > 4:
+            status['metadata'] = int(fields[4])
+    except ValueError:
+        status['state'] = ' '.join(fields[3:])
+    return status
+
+
 class DeviceMapperSnapshot(object):
-    def __init__(self, imgloop, cowloop, ops=''):
+    """A Device-mapper snapshot of imgloop, with its exceptions in cowloop.
+
+    chunksize is the snapshot chunk size in sectors; an existing persistent
+    store keeps the chunk size recorded in its header.  persistent is 'P',
+    'PO' or 'N', or None to choose from the ops given to create().
+    """
+    def __init__(self, imgloop, cowloop, ops='',
+                 chunksize=SNAPSHOT_CHUNK_SECTORS, persistent=None):
         self.imgloop = imgloop
         self.cowloop = cowloop
-        self.persistent = 'PO'
+        self.persistent = persistent or 'PO'
+        self.chunksize = chunksize
 
+        self.__persistent = persistent
         self.__created = False
         self.__name = None
 
@@ -1297,6 +2143,9 @@ class DeviceMapperSnapshot(object):
     def create(self, ops=''):
         if self.__created:
             return
+        if not check_chunksize(self.chunksize):
+            raise SnapshotError('Invalid snapshot chunk size: %s sectors' %
+                                self.chunksize)
 
         self.imgloop.create(ops=ops)
         self.cowloop.create()
@@ -1306,31 +2155,28 @@ class DeviceMapperSnapshot(object):
 
         size = os.stat(self.imgloop.lofile)[stat.ST_SIZE]
 
-        if '--readonly' in ops or '-r' in ops or 'ro' in ops:
-            self.persistent = 'P'
-        if ('tmpfs' == self.cowloop.fstype or 'N' in ops):
-            self.persistent = 'N'
-        if 'P' in ops:
-            self.persistent = 'P'
-        if 'PO' in ops:
-            self.persistent = 'PO'
-
-        table = '0 %d snapshot %s %s %s 8' % (size // 512,
-                                              self.imgloop.device,
-                                              self.cowloop.device,
-                                              self.persistent)
-
-        args = ['dmsetup', 'create', self.__name, '-vv', '--verifyudev',
-                '--uuid', 'LIVECD-%s' % self.__name, '--table', table]
-
-        if '--readonly' in ops or '-r' in ops or 'ro' in ops:
-            args += ['--readonly']
-        if call(args) != 0:
-            time.sleep(1)
+        if not self.__persistent:
+            if '--readonly' in ops or '-r' in ops or 'ro' in ops:
+                self.persistent = 'P'
+            if ('tmpfs' == self.cowloop.fstype or 'N' in ops):
+                self.persistent = 'N'
+            if 'P' in ops:
+                self.persistent = 'P'
+            if 'PO' in ops:
+                self.persistent = 'PO'
+
+        readonly = '--readonly' in ops or '-r' in ops or 'ro' in ops
+        table = '0 %d snapshot %s %s %s %d' % (size // 512,
+                                               self.imgloop.device,
+                                               self.cowloop.device,
+                                               self.persistent,
+                                               self.chunksize)
+
+        if dm_manager.create(self.__name, table, readonly) != 0:
             self.cowloop.cleanup()
             self.imgloop.cleanup()
-            raise SnapshotError('Could not create snapshot device using: ' +
-                                ' '.join(args))
+            raise SnapshotError('Could not create snapshot device %s using '
+                                'table: %s' % (self.__name, table))
 
         self.__created = True
         self.device = os.path.join('/dev/mapper', self.__name)
@@ -1339,9 +2185,7 @@ class DeviceMapperSnapshot(object):
         if not self.__created:
             return
 
-        # sleep to try to avoid any dm shenanigans
-        time.sleep(2)
-        rc = call(['dmsetup', 'remove', self.__name])
+        rc = dm_manager.remove(self.__name)
         if not ignore_errors and rc != 0:
             raise SnapshotError('Could not remove snapshot device.')
 
@@ -1354,31 +2198,98 @@ class DeviceMapperSnapshot(object):
     def cleanup(self):
         self.remove()
 
+    def get_status(self):
+        if not self.__created:
+            return None
+        return snapshot_status(self.__name)
+
     def get_cow_used(self):
         if not self.__created:
             return 0
 
-        dev_null = os.open('/dev/null', os.O_WRONLY)
+        status = snapshot_status(self.__name)
+        if status['state'] != 'valid':
+            raise SnapshotError("Snapshot '%s' is unusable: %s" %
+                                (self.__name, status['state']))
+        return status['allocated'] * 512
+
+
+def benchmark_snapshot_chunks(origin, chunksizes=(8, 32, 128, 512),
+                              workdir=None, writes=1024, reads=1024,
+                              iosize=4096):
+    """Measure snapshot overlay behaviour of the image file origin at each
+    chunk size in chunksizes (in sectors).
+
+    For each chunk size a persistent snapshot is made over a new sparse
+    store in workdir (put it on the overlay device to measure that device),
+    writes random iosize blocks and then reads random blocks with O_DIRECT.
+    The same offsets are used for every chunk size.  Returns a list of dicts
+    with the chunk size, the bytes written, the store and metadata bytes
+    allocated, the write amplification (store bytes per byte written), and
+    the median and 99th percentile read latencies in milliseconds.
+    """
+    import mmap
+
+    size = os.stat(origin).st_size
+    nblocks = size // iosize
+    buf = mmap.mmap(-1, iosize)
+    buf.write(os.urandom(iosize))
+    results = []
+    for chunksize in chunksizes:
+        rng = random.Random(0)
+        chunk = chunksize * 512
+        cowfile = tempfile.NamedTemporaryFile(prefix='cowbench-', dir=workdir,
+                                              delete=False).name
+        snap = DeviceMapperSnapshot(LoopbackDisk(origin, None, '-r'),
+                                    SparseLoopbackDisk(cowfile,
+                                        (writes + writes // 16 + 16) * chunk),
+                                    chunksize=chunksize, persistent='P')
+        fd = None
         try:
-            out = subprocess.Popen(['dmsetup', 'status', self.__name],
-                                   stdout=subprocess.PIPE,
-                                   stderr=dev_null).communicate()[0]
+            snap.create()
+            fd = os.open(snap.path, os.O_RDWR | os.O_DIRECT)
+            for i in range(writes):
+                os.pwrite(fd, buf, rng.randrange(nblocks) * iosize)
+            os.fsync(fd)
+            status = snap.get_status()
+            if status['state'] != 'valid':
+                raise SnapshotError('Benchmark snapshot is unusable at a '
+                                    'chunk size of %d sectors: %s' %
+                                    (chunksize, status['state']))
+
+            for path in (origin, cowfile):
+                f = os.open(path, os.O_RDONLY)
+                os.posix_fadvise(f, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.close(f)
+            latencies = []
+            for i in range(reads):
+                offset = rng.randrange(nblocks) * iosize
+                t0 = time.perf_counter()
+                os.preadv(fd, [buf], offset)
+                latencies.append(time.perf_counter() - t0)
+            latencies.sort()
         finally:
-            os.close(dev_null)
-
-        # dmsetup status on a snapshot returns, e.g.,
-        #   "0 8388608 snapshot 416/1048576 260"
-        # following the pattern:
-        #   "A B snapshot C/D E"
-        # where C is the number of 512 byte sectors allocated
-        #  from D          "        "   "     "     in the overlay
-        #   and E          "        "   "     "     of metadata
-        #       A is the start sector of the filesystem
-        #       B        size of the filesystem in 512 byte sectors.
-        try:
-            return int((out.split()[3]).split(b'/')[0]) * 512
-        except ValueError:
-            raise SnapshotError('Failed to parse dmsetup status: ' + out)
+            if fd is not None:
+                os.close(fd)
+            snap.remove(ignore_errors=True)
+            snap.cowloop.cleanup()
+            snap.imgloop.cleanup()
+            os.unlink(cowfile)
+
+        written = writes * iosize
+        results.append({
+            'chunksize': chunksize,
+            'written': written,
+            'cow_bytes': status['allocated'] * 512,
+            'metadata_bytes': status['metadata'] * 512,
+            'amplification': status['allocated'] * 512 / written,
+            'read_ms_median': latencies[len(latencies) // 2] * 1000,
+            'read_ms_p99': latencies[len(latencies) * 99 // 100] * 1000})
+        logging.info('snapshot chunk %d KiB: write amplification %.2f, read '
+                     'latency median %.3f ms' % (chunksize // 2,
+                     results[-1]['amplification'],
+                     results[-1]['read_ms_median']))
+    return results
 
 
 class CryptoLUKSDevice(object):
@@ -1584,6 +2495,9 @@ class LiveImageMount(object):
         self.dm_target = None
         self.homemnt = None
         self.EncHome = None
+        self.chunksize = None
+        """Chunk size, in sectors, for new snapshot overlays; None leaves it
+        to the first activation."""
 
     def __create(self, ops='', dirmode=None):
         if self.__created:
@@ -1620,7 +2534,8 @@ class LiveImageMount(object):
         else:
             sqfs_img = os.path.join(self.liveosdir, 'squashfs.img')
         if os.path.exists(sqfs_img):
-            self.squashloop = LoopbackDisk(sqfs_img, None, '-r')
+            self.squashloop = LoopbackDisk(sqfs_img, None, '-r',
+                                           role='source')
 
             self.squashmnt = DiskMount(self.squashloop, ''.join((self.mountdir,
                                        'sqmt')), ops='ro', dirmode=dirmode)
@@ -1636,7 +2551,8 @@ class LiveImageMount(object):
                 if not os.path.exists(rootfs_img):
                     rootfs_img = os.path.join(self.squashmnt.mountdir,
                                               'LiveOS', 'ext3fs.img')
-                self.imgloop = LoopbackDisk(rootfs_img, None, '-r')
+                self.imgloop = LoopbackDisk(rootfs_img, None, '-r',
+                                            role='source')
                 lower = self.imgloop
         else:
             rootfs_img = os.path.join(self.liveosdir, 'rootfs.img')
@@ -1644,7 +2560,8 @@ class LiveImageMount(object):
                 rootfs_img = os.path.join(self.liveosdir, 'ext3fs.img')
             if not os.path.exists(rootfs_img):
                 raise SnapshotError('Failed to find a LiveOS root image.')
-            lower = self.imgloop = LoopbackDisk(rootfs_img, None)
+            lower = self.imgloop = LoopbackDisk(rootfs_img, None,
+                                                role='source')
             self.squashloop = None
 
         if self.overlay and ':' in self.overlay:
@@ -1675,7 +2592,7 @@ class LiveImageMount(object):
                 size = None
             else:
                 cow = self.cowloop = LoopbackDisk(self.overlay, None,
-                                                  ops=ops)
+                                                  ops=ops, role='cow')
                 work = None
                 self.cowloop.create('ro')
                 size = cow._size = os.stat(self.overlay)[stat.ST_SIZE]
@@ -1699,12 +2616,15 @@ class LiveImageMount(object):
                 self.overlay = tempfile.NamedTemporaryFile(prefix='ovl-',
                                                            delete=False).name
                 self.overlay = self.cowloop = SparseLoopbackDisk(
-                                                  self.overlay, 32 * 1024 ** 3)
+                                                  self.overlay, 32 * 1024 ** 3,
+                                                  role='cow')
                 self.ovltype = 'temp'
         if not self.dm_target and self.ovltype in ('', 'DM_snapshot_cow',
                                                    'temp'):
             self.dm_target = DeviceMapperSnapshot(self.imgloop,
-                                                  self.cowloop, ops=ops)
+                                  self.cowloop, ops=ops,
+                                  chunksize=self.chunksize or
+                                            SNAPSHOT_CHUNK_SECTORS)
             self.ovltype = 'DM_snapshot_cow'
         if self.ovltype not in ('DM_linear', 'DM_snapshot_cow', 'temp'):
             self.livemount = OverlayFSMount('overlayfs', lower, cow, work,
@@ -1728,8 +2648,14 @@ class LiveImageMount(object):
             self.ovlmnt.unmount()
 
     def make_overlay(self, size=512*1024**2, existing_size=0, ovltype='',
-                     ovl_fstype='', ovl_blksz=None, ops='', dirmode=None):
-        """Register a new or modified LiveOS overlay."""
+                     ovl_fstype='', ovl_blksz=None, ops='', dirmode=None,
+                     alloc='sparse'):
+        """Register a new or modified LiveOS overlay.
+
+        alloc is one of OVERLAY_ALLOC_MODES and selects how the overlay file
+        is allocated.  For a snapshot overlay, ovl_blksz is the snapshot
+        chunk size in bytes.
+        """
 
         if self.ovlmnt:
             self.ovlmnt.mount()
@@ -1765,30 +2691,47 @@ class LiveImageMount(object):
         else:
             overfile = self.overlay
 
+        snapshot_types = ('', 'temp', 'DM_snapshot_cow')
+
         def _wipe_overlay(otype):
+            """Remove the old overlay, or, when a snapshot overlay replaces
+            a snapshot overlay, keep its allocation and zero only its header.
+            Return the size of any retained file."""
+            retained = 0
             self.unmount()
             if otype == 'dir':
                 shutil.rmtree(os.path.join(overfile, '..', 'ovlwork'))
                 shutil.rmtree(overfile)
+            elif otype in snapshot_types and ovl_fstype in snapshot_types:
+                # The snapshot must be gone before its header is cleared.
+                if self.dm_target:
+                    self.dm_target.remove()
+                    self.dm_target = None
+                wipe_header(overfile)
+                retained = os.stat(overfile).st_size
             else:
                 os.remove(overfile)
             self.cleanup()
+            return retained
 
         if os.path.exists(overfile):
-            _wipe_overlay(self.ovltype)
-            existing_size = 0
+            existing_size = _wipe_overlay(self.ovltype)
         if self.ovlmnt:
             self.ovlmnt.mount()
         if ovl_fstype == 'dir':
             makedirs(overfile, 0o755)
             makedirs(os.path.join(overfile, '..', 'ovlwork'), 0o755)
             call(['chcon', '--reference=/.', overfile])
-        elif ovl_fstype in ('', 'temp', 'DM_snapshot_cow'):
-            self.overlay = SparseLoopbackDisk(overfile, size)
+        elif ovl_fstype in snapshot_types:
+            if ovl_blksz:
+                self.chunksize = int(ovl_blksz) // 512
+            self.overlay = SparseLoopbackDisk(overfile, min(size,
+                                              existing_size) or size,
+                                              alloc=alloc)
             self.overlay.create(ops=ops, dirmode=dirmode)
             self.overlay.cleanup()
             self.ovltype = 'DM_snapshot_cow'
-        if ovl_fstype not in ('', 'temp', 'DM_snapshot_cow'):
+        if ovl_fstype not in snapshot_types:
             if self.imgloop == self.squashloop:
                 lower = self.squashmnt
             else:
@@ -1797,7 +2740,8 @@ class LiveImageMount(object):
                                             self.mountdir, size=size,
                                             ops=ops, dirmode=dirmode)
         if ovl_fstype != 'dir':
-            self.resize_overlay(size, existing_size, ovl_fstype, ovl_blksz)
+            self.resize_overlay(size, existing_size, ovl_fstype, ovl_blksz,
+                                alloc)
 
         self.ovltype = ovl_fstype
         if self.ovlmnt:
@@ -1807,27 +2751,49 @@ class LiveImageMount(object):
         return (self.overlay, device[0])
 
     def resize_overlay(self, overlay_size_mb, existing_size, ovl_fstype,
-                       ovl_blksz):
+                       ovl_blksz, alloc=None):
         if ovl_fstype in ('', 'temp', 'DM_snapshot_cow'):
             overlay = self.overlay
             self.reset_overlay()
             if overlay_size_mb > existing_size:
-                overlay.expand(create=True, size=overlay_size_mb)
+                overlay.expand(create=True, size=overlay_size_mb, alloc=alloc)
             else:
                 overlay.truncate(size=overlay_size_mb)
         else:
             overlay = self.livemount.cowloop
+            if alloc:
+                overlay.alloc = alloc
             self.livemount.create_ovlfs(ovl_fstype, ovl_blksz, 'overlayfs',
                                         dirmode=0o755)
 
+    def benchmark_chunks(self, chunksizes, workdir=None, **kwargs):
+        """Run benchmark_snapshot_chunks() on the root filesystem image,
+        with the stores on the overlay device when it is writable."""
+
+        self.__create(ops='ro')
+        if workdir is None:
+            if self.ovlmnt:
+                self.ovlmnt.mount()
+                workdir = self.ovlmntdir
+            else:
+                workdir = self.liveosdir
+            if not os.access(workdir, os.W_OK):
+                workdir = None
+        return benchmark_snapshot_chunks(self.imgloop.lofile, chunksizes,
+                                         workdir, **kwargs)
+
     def reset_overlay(self):
         if self.ovlmnt:
             self.ovlmnt.mount()
         if self.ovltype in ('', 'temp', 'DM_snapshot_cow'):
-            reset_overlay_args = ['dd', 'if=/dev/zero', 'of=%s' %
-                                  self.overlay, 'bs=64k', 'count=1',
-                                  'conv=notrunc,fsync']
-            call(reset_overlay_args)
+            # Only the snapshot header need be cleared.
+            overlay = self.overlay
+            if isinstance(overlay, LoopbackDisk):
+                overlay = overlay.lofile
+            if self.chunksize:
+                write_snapshot_header(overlay, self.chunksize)
+            else:
+                wipe_header(overlay)
         else:
             self.unmount()
             if self.ovlmnt:
@@ -1870,7 +2836,7 @@ class LiveImageMount(object):
             self.livemount.unmount()
         if self.homemnt:
             self.homemnt.unmount()
-            time.sleep(2)
+            dm_manager.settle()
         if self.ovlmnt:
             self.ovlmnt.unmount()
         self.mounted = False
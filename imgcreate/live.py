@@ -28,12 +28,19 @@ import shutil
 import subprocess
 import logging
 import re
+import time
 import hawkey
 import dnf.rpm
 
 from imgcreate.errors import *
 from imgcreate.fs import *
 from imgcreate.creator import *
+from imgcreate import preload
+from imgcreate import progress
+from imgcreate import metrics
+from imgcreate import planner
+from imgcreate import pkgsizes
+from imgcreate import chunks
 
 class LiveImageCreatorBase(LoopImageCreator):
     """A base class for LiveCD image creators.
@@ -74,6 +81,41 @@ class LiveImageCreatorBase(LoopImageCreator):
         self.skip_hfs = False
         """Controls whether to create a hfs boot image."""
 
+        self.read_profile = None
+        """A file listing root filesystem paths in boot-time read order, used
+        to lay out a flattened squashfs.img."""
+
+        self.regenerate_initramfs = False
+        """Controls whether to rebuild the initramfs of all kernels, in
+        parallel, once the %post scripts have run."""
+
+        self.initramfs_jobs = None
+        """Maximum concurrent dracut runs; None means one per kernel, up to
+        the CPU count."""
+
+        self.preload = False
+        """Controls whether to ship a boot path preload manifest and the
+        service that prefetches it."""
+
+        self.dir_root = False
+        """Controls whether a flattened squashfs build installs into a plain
+        directory, or a btrfs subvolume, instead of a loop-mounted image."""
+
+        self.size_report = None
+        """Path of the per-package size report of the squashfs image, if one
+        is to be written; a report already there is diffed against."""
+
+        self.chunk_index = None
+        """Method of the chunk indexes written next to the ISO and squashfs
+        image for delta downloads, one of chunks.CHUNKERS, or None."""
+
+        self.chunk_store = None
+        """Chunk store directory of the desync and casync indexes, shared by
+        successive builds; it is needed for those methods."""
+
+        self.__staged_initramfs = []
+        """The (source, destination) paths of the staged initramfs images."""
+
         self._timeout = kickstart.get_timeout(self.ks, 10)
         """The bootloader timeout from kickstart."""
 
@@ -216,10 +258,16 @@ class LiveImageCreatorBase(LoopImageCreator):
                 "LiveOS/rootfs.img, ext3fs.img, nor squashfs.img exist" %
                 base_on)
 
+            if self.dir_root and os_image != squashimg:
+                raise CreatorError("A directory install root can only be "
+                                   "based on a flattened squashfs image; "
+                                   "'%s' holds %s" % (base_on, os_image))
+
             print('Copying base-on image from %s...' % base_on)
             if os_image == squashimg:
                 try:
-                    self._LoopImageCreator__instloop.mount()
+                    if not self.dir_root:
+                        self._LoopImageCreator__instloop.mount()
                 except MountError as e:
                     raise CreatorError("Failed to loop mount the new rootfs "
                                    "on '%s' : %s" % (self._instroot, e))
@@ -238,7 +286,12 @@ class LiveImageCreatorBase(LoopImageCreator):
 
     def _mount_instroot(self, base_on = None):
         self.base_on = True
-        LoopImageCreator._mount_instroot(self, base_on)
+        if self.dir_root:
+            self.__make_dir_root()
+            if base_on is not None:
+                self._base_on(base_on)
+        else:
+            LoopImageCreator._mount_instroot(self, base_on)
         self.__write_initrd_conf(self._instroot + "/etc/sysconfig/mkinitrd")
         self.__write_dracut_conf(self._instroot + "/etc/dracut.conf.d/99-liveos.conf")
 
@@ -248,6 +301,59 @@ class LiveImageCreatorBase(LoopImageCreator):
         self.__add_files()
         LoopImageCreator._unmount_instroot(self)
 
+    def __make_dir_root(self):
+        """Prepare the install root directory of a dir_root build: on RAM
+        storage if ram_root is set and fits, else as a btrfs subvolume
+        where the build directory is on btrfs, else as it is."""
+
+        root = self._instroot
+        if os.path.ismount(root) or os.listdir(root):
+            # A resumed build.
+            return
+        if self.ram_root and self._mount_ram_store(root):
+            return
+        if findmnt('-no FSTYPE -T', root) == 'btrfs':
+            os.rmdir(root)
+            if call(['btrfs', 'subvolume', 'create', root]) == 0:
+                return
+            makedirs(root)
+
+    def _release_instroot(self):
+        LoopImageCreator._release_instroot(self)
+        root = self._instroot
+        # A btrfs subvolume root always has inode number 256.
+        if (self.dir_root and os.path.isdir(root) and
+            os.stat(root).st_ino == 256 and
+            findmnt('-no FSTYPE -T', root) == 'btrfs'):
+            call(['btrfs', 'subvolume', 'delete', root])
+
+    def _checkpoint_state(self):
+        state = LoopImageCreator._checkpoint_state(self)
+        state.update({'isodir': self.__isodir,
+                      'compress_args': self.compress_args})
+        return state
+
+    def _restore_checkpoint_state(self, state):
+        LoopImageCreator._restore_checkpoint_state(self, state)
+        self.__isodir = state['isodir']
+        self.compress_args = state['compress_args']
+
+    def _checkpoint_files(self):
+        files = LoopImageCreator._checkpoint_files(self)
+        if self.dir_root:
+            # The root directory has no image file; its rpmdb stands for it,
+            # so that a root lost since the checkpoint is not built on.
+            for db in ('usr/lib/sysimage/rpm/rpmdb.sqlite',
+                       'var/lib/rpm/rpmdb.sqlite', 'var/lib/rpm/Packages'):
+                if os.path.isfile(os.path.join(self._instroot, db)):
+                    files.append(os.path.join(self._instroot, db))
+                    break
+        if self.__isodir:
+            squashimg = os.path.join(self.__isodir, 'LiveOS', 'squashfs.img')
+            if os.path.exists(squashimg):
+                files.append(squashimg)
+        return files
+
     def __ensure_isodir(self):
         if self.__isodir is None:
             self.__isodir = self._mkdtemp("iso-")
@@ -273,6 +379,58 @@ class LiveImageCreatorBase(LoopImageCreator):
             self._instroot + "/usr/lib/grub/i386-pc", "-o", isodir +
             "/images/eltorito.img", "-p", "/boot/grub2", "iso9660", "biosdisk"])
 
+    def _regenerate_initramfs(self):
+        """Rebuild the initramfs of every installed kernel, one dracut process
+        per kernel, running concurrently with up to initramfs_jobs at once.
+        The dracut configuration written by __write_dracut_conf applies.
+        """
+        import concurrent.futures
+
+        versions = [v for k in self._get_kernel_versions().values() for v in k]
+        if not versions:
+            return
+        jobs = self.initramfs_jobs or min(len(versions), os.cpu_count() or 1)
+
+        def _dracut(version):
+            t0 = time.time()
+            # preexec_fn is not safe in threads, so chroot(1) is run.
+            p = subprocess.run(["chroot", self._instroot, "dracut", "--force",
+                                "--kver", version,
+                                "/boot/initramfs-%s.img" % version],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in p.stdout.decode('utf-8', 'replace').splitlines():
+                logging.debug("dracut %s: %s" % (version, line))
+            if p.returncode != 0:
+                raise CreatorError("dracut failed for kernel %s (%d)" %
+                                   (version, p.returncode))
+            return time.time() - t0
+
+        logging.info("Regenerating %d initramfs images with %d jobs" %
+                     (len(versions), jobs))
+        t0 = time.time()
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            for version, secs in zip(versions, pool.map(_dracut, versions)):
+                logging.info("initramfs for %s built in %.1f s" %
+                             (version, secs))
+        logging.info("initramfs regeneration took %.1f s" % (time.time() - t0))
+
+    def _stage_initramfs(self, src, dst):
+        """Stage the initramfs src at dst, to be staged again if it is
+        regenerated after the %post scripts."""
+        stage_file(src, dst)
+        self.__staged_initramfs.append((src, dst))
+
+    def _run_post_scripts(self):
+        LoopImageCreator._run_post_scripts(self)
+        if not self.regenerate_initramfs:
+            return
+        # The %post scripts may change the dracut configuration, modules or
+        # firmware, so the initramfs is only rebuilt once they have run.
+        self._regenerate_initramfs()
+        for src, dst in self.__staged_initramfs:
+            if os.path.exists(src):
+                stage_file(src, dst)
+
     def _create_bootconfig(self):
         """Configure the image so that it's bootable."""
         self._configure_bootloader(self.__ensure_isodir())
@@ -378,7 +536,8 @@ early_microcode=no
 
         args = ["xorrisofs"]
 
-        if max(iterate_files_recursively(isodir)) >= 4 * 1024**3:
+        sizes = list(iterate_files_recursively(isodir))
+        if max(sizes) >= 4 * 1024**3:
             args += ["-iso-level", "3"]
 
         args += ["-output", iso, "-rational-rock", "-joliet",
@@ -388,8 +547,11 @@ early_microcode=no
 
         args.append(isodir)
 
-        if subprocess.call(args) != 0:
-            raise CreatorError("ISO creation failed!")
+        # The ISO is about the size of the files it holds.
+        with progress.FileGrowth('iso', iso, sum(sizes)):
+            if subprocess.call(args) != 0:
+                raise CreatorError("ISO creation failed!")
+        metrics.set_value('iso_size_bytes', os.path.getsize(iso))
 
         self.__implant_md5sum(iso)
 
@@ -407,43 +569,177 @@ early_microcode=no
                             'not setting up mediacheck')
         return
 
+    def __read_profile_sort(self, os_image):
+        """Write a mksquashfs sort file from the read profile, report the
+        expected effect on seeks, and return the mksquashfs arguments."""
+
+        sort_file = os.path.join(self._ImageCreator__builddir, 'squashfs.sort')
+        found, before, after = squashfs_sort_file(self.read_profile, os_image,
+                                                  sort_file)
+        if not found:
+            logging.warning('No file in read profile %s is in the image' %
+                            self.read_profile)
+            return []
+        print('Read profile: %d files; estimated seeks %d -> %d, '
+              'seek distance %.1f -> %.1f MiB' % (found, before[0], after[0],
+              before[1] / 1024.0 ** 2, after[1] / 1024.0 ** 2))
+        logging.info('Read profile %s: %d files, seeks %d -> %d, distance '
+                     '%d -> %d bytes' % (self.read_profile, found, before[0],
+                     after[0], before[1], after[1]))
+        return ['-sort', sort_file]
+
     def _stage_final_image(self, ops=[]):
+        staged = False
         try:
             makedirs(self.__ensure_isodir() + "/LiveOS")
+            if not self.checkpoint_reached('squash'):
+                if self.preload:
+                    self.__write_preload()
+                packages = None
+                if self.size_report:
+                    packages = self.__scan_package_sizes()
+                with metrics.phase('squash'):
+                    self.__squash_image(ops)
+                self.__record_squash_ratio()
+                if packages is not None:
+                    self.__write_size_report(packages)
+                self.checkpoint('squash')
+
+            if self.chunk_index and self.chunk_index != 'zsync':
+                # The squashfs image is only published through the store,
+                # so a zsync index of it would have nothing to fetch from.
+                index = "%s/%s-squashfs.img%s" % (self._outdir, self.name,
+                                    chunks.INDEX_SUFFIX[self.chunk_index])
+                with metrics.phase('squashfs-index'):
+                    chunks.make_index(self.__isodir + "/LiveOS/squashfs.img",
+                                      self.chunk_index, self.__chunk_store(),
+                                      index)
+
+            with metrics.phase('iso'):
+                self.__create_iso(self.__isodir)
+            if self.chunk_index:
+                with metrics.phase('iso-index'):
+                    chunks.make_index(self._outdir + "/" + self.name + ".iso",
+                                      self.chunk_index, self.__chunk_store())
+            staged = True
+        finally:
+            # With checkpoints, a failed build keeps the staged .iso tree.
+            if staged or not self.checkpoints:
+                shutil.rmtree(self.__isodir, ignore_errors = True)
+                self.__isodir = None
 
-            self._resparse()
+    def __chunk_store(self):
+        if self.chunk_index == 'zsync':
+            return None
+        if not self.chunk_store:
+            raise CreatorError("A chunk store is needed for %s chunk indexes"
+                               % self.chunk_index)
+        return self.chunk_store
+
+    def _plan_sizes(self, plan):
+        LoopImageCreator._plan_sizes(self, plan)
+        if self.dir_root and self._LoopImageCreator__ramstore is None:
+            plan.need(self._ImageCreator__builddir, "install root",
+                      plan.growth())
+        if self.skip_compression:
+            plan.squashfs = plan.rootfs
+            plan.iso = plan.rootfs + planner.ISO_EXTRA
+        else:
+            plan.predict_squashfs(self.compress_args)
+        # The ISO tree and the ISO are both staged in the build directory.
+        plan.need(self._outdir, "squashfs", plan.squashfs)
+        plan.need(self._outdir, "ISO", plan.iso)
+
+    def __record_squash_ratio(self):
+        plan = self._size_plan
+        if plan is None or not plan.fresh or self.skip_compression:
+            return
+        size = os.path.getsize(self.__isodir + "/LiveOS/squashfs.img")
+        plan.history.record('squashfs', size / plan.installed,
+                            self.compress_args)
+
+    def __write_preload(self):
+        """Ship the preload manifest of the finished root, and the service
+        that reads it at boot."""
+        if not self.dir_root:
+            self._LoopImageCreator__instloop.mount()
+        try:
+            n = preload.write_preload_manifest(self._instroot,
+                                               self.read_profile)
+            preload.write_preload_service(self._instroot)
+        finally:
+            if not self.dir_root:
+                self._LoopImageCreator__instloop.cleanup()
+        print('Preload manifest: %d files' % n)
+
+    def __scan_package_sizes(self):
+        """Attribute the files of the install root to their packages, before
+        the root image is consumed by the squashing."""
+        if self.dir_root:
+            return pkgsizes.scan(self._instroot)
+        self._LoopImageCreator__instloop.mount('ro')
+        try:
+            return pkgsizes.scan(self._instroot)
+        finally:
             self._LoopImageCreator__instloop.cleanup()
 
-            os_image = os.path.join('LiveOS', 'rootfs.img')
-            if self.skip_compression:
-                os_image = os.path.join(self.__isodir, os_image)
-                shutil.move(self._image, os_image)
+    def __write_size_report(self, packages):
+        squashfs_size = None
+        if not self.skip_compression:
+            squashfs_size = os.path.getsize(self.__isodir +
+                                            "/LiveOS/squashfs.img")
+        report = pkgsizes.make_report(packages, squashfs_size,
+                                      pkgsizes.load(self.size_report))
+        report['image'] = self.name
+        pkgsizes.write(self.size_report, report)
+        print(pkgsizes.summary(report))
+
+    def __squash_image(self, ops):
+        if self.dir_root:
+            # Nothing to resparse or remount; squash the tree as it is.
+            if 'flatten-squashfs' in ops:
+                ops.remove('flatten-squashfs')
+            if self.read_profile:
+                ops = ops + self.__read_profile_sort(self._instroot)
+            mksquashfs(self._instroot,
+                       self.__isodir + "/LiveOS/squashfs.img",
+                       self.compress_args, ops)
+            return
+
+        self._resparse()
+        self._LoopImageCreator__instloop.cleanup()
+
+        os_image = os.path.join('LiveOS', 'rootfs.img')
+        if self.skip_compression:
+            os_image = os.path.join(self.__isodir, os_image)
+            shutil.move(self._image, os_image)
+        else:
+            if 'flatten-squashfs' in ops:
+                ops.remove('flatten-squashfs')
+                self._LoopImageCreator__instloop.mount('ro')
+                os_image = self._instroot
+                if self.read_profile:
+                    ops = ops + self.__read_profile_sort(os_image)
             else:
-                if 'flatten-squashfs' in ops:
-                    ops.remove('flatten-squashfs')
-                    self._LoopImageCreator__instloop.mount('ro')
-                    os_image = self._instroot
+                if self.read_profile:
+                    logging.warning('A read profile only applies to a '
+                                    'flattened squashfs; ignoring %s' %
+                                    self.read_profile)
+                makedirs(os.path.join(
+                                 os.path.dirname(self._image), "LiveOS"))
+                os_image = os.path.join(
+                                   os.path.dirname(self._image), os_image)
+                shutil.move(self._image, os_image)
+                os_image = os.path.dirname(self._image)
+            mksquashfs(os_image,
+                       self.__isodir + "/LiveOS/squashfs.img",
+                       self.compress_args, ops)
+            self._LoopImageCreator__instloop.cleanup()
+            if self.docleanup:
+                if os_image == self._instroot:
+                    os.remove(self._image)
                 else:
-                    makedirs(os.path.join(
-                                     os.path.dirname(self._image), "LiveOS"))
-                    os_image = os.path.join(
-                                       os.path.dirname(self._image), os_image)
-                    shutil.move(self._image, os_image)
-                    os_image = os.path.dirname(self._image)
-                mksquashfs(os_image,
-                           self.__isodir + "/LiveOS/squashfs.img",
-                           self.compress_args, ops)
-                self._LoopImageCreator__instloop.cleanup()
-                if self.docleanup:
-                    if os_image == self._instroot:
-                        os.remove(self._image)
-                    else:
-                        os.remove(os.path.join(os_image, 'LiveOS', 'rootfs.img'))
-
-            self.__create_iso(self.__isodir)
-        finally:
-            shutil.rmtree(self.__isodir, ignore_errors = True)
-            self.__isodir = None
+                    os.remove(os.path.join(os_image, 'LiveOS', 'rootfs.img'))
 
 
 class x86LiveImageCreator(LiveImageCreatorBase):
@@ -542,27 +838,30 @@ class x86LiveImageCreator(LiveImageCreatorBase):
         bootdir = self._instroot + "/boot"
 
         makedirs(os.path.join(isodir, self._imgdir))
-        shutil.copy2(os.path.join(bootdir, "vmlinuz-" + version),
-                        os.path.join(isodir, self._imgdir, "vmlinuz" + index))
+        stage_file(os.path.join(bootdir, "vmlinuz-" + version),
+                   os.path.join(isodir, self._imgdir, "vmlinuz" + index))
 
         isDracut = False
         if os.path.exists(self._instroot + "/usr/bin/dracut"):
             isDracut = True
 
         # FIXME: Implement a better check for how the initramfs is named...
+        initrd = os.path.join(isodir, self._imgdir, "initrd" + index + ".img")
         if os.path.exists(os.path.join(bootdir, "initramfs-" + version + ".img")):
-            shutil.copy2(os.path.join(bootdir, "initramfs-" + version + ".img"),
-                            os.path.join(isodir, self._imgdir, "initrd" + index + ".img"))
+            self._stage_initramfs(os.path.join(bootdir,
+                                               "initramfs-" + version + ".img"),
+                                  initrd)
         elif os.path.exists(os.path.join(bootdir, "initrd-" + version + ".img")):
-            shutil.copy2(os.path.join(bootdir, "initrd-" + version + ".img"),
-                            os.path.join(isodir, self._imgdir, "initrd" + index + ".img"))
+            self._stage_initramfs(os.path.join(bootdir,
+                                               "initrd-" + version + ".img"),
+                                  initrd)
         elif not self.base_on:
             logging.error("No initramfs or initrd found for %s" % (version,))
 
         is_xen = False
         if os.path.exists(os.path.join(bootdir, "xen.gz-" + version[:-3])):
-            shutil.copy2(os.path.join(bootdir, "xen.gz-" + version[:-3]),
-                            os.path.join(isodir, "xen" + index + ".gz"))
+            stage_file(os.path.join(bootdir, "xen.gz-" + version[:-3]),
+                       os.path.join(isodir, "xen" + index + ".gz"))
             is_xen = True
 
         return (is_xen, isDracut)
@@ -1077,16 +1376,16 @@ class ppcLiveImageCreator(LiveImageCreatorBase):
 
         makedirs(destdir)
 
-        shutil.copy2(bootdir + "/vmlinuz-" + version,
-                        destdir + "/vmlinuz")
+        stage_file(bootdir + "/vmlinuz-" + version,
+                   destdir + "/vmlinuz")
 
         if os.path.exists(bootdir + "/initramfs-" + version + ".img"):
-            shutil.copy2(bootdir + "/initramfs-" + version + ".img",
-                            destdir + "/initrd.img")
+            self._stage_initramfs(bootdir + "/initramfs-" + version + ".img",
+                                  destdir + "/initrd.img")
             isDracut = True
         else:
-            shutil.copy2(bootdir + "/initrd-" + version + ".img",
-                            destdir + "/initrd.img")
+            self._stage_initramfs(bootdir + "/initrd-" + version + ".img",
+                                  destdir + "/initrd.img")
 
         return isDracut
 
@@ -1249,8 +1548,8 @@ class aarch64LiveImageCreator(LiveImageCreatorBase):
     def __copy_kernel_and_initramfs(self, isodir, version, index):
         bootdir = self._instroot + "/boot"
         makedirs(isodir + "/LiveOS/")
-        shutil.copy2(bootdir + "/vmlinuz-" + version,
-                        isodir + "/LiveOS/vmlinuz" + index)
+        stage_file(bootdir + "/vmlinuz-" + version,
+                   isodir + "/LiveOS/vmlinuz" + index)
 
         isDracut = False
         if os.path.exists(self._instroot + "/usr/bin/dracut"):
@@ -1258,11 +1557,11 @@ class aarch64LiveImageCreator(LiveImageCreatorBase):
 
         # FIXME: Implement a better check for how the initramfs is named...
         if os.path.exists(bootdir + "/initramfs-" + version + ".img"):
-            shutil.copy2(bootdir + "/initramfs-" + version + ".img",
-                            isodir + "/LiveOS/initrd" + index + ".img")
+            self._stage_initramfs(bootdir + "/initramfs-" + version + ".img",
+                                  isodir + "/LiveOS/initrd" + index + ".img")
         elif os.path.exists(bootdir + "/initrd-" + version + ".img"):
-            shutil.copy2(bootdir + "/initrd-" + version + ".img",
-                            isodir + "/LiveOS/initrd" + index + ".img")
+            self._stage_initramfs(bootdir + "/initrd-" + version + ".img",
+                                  isodir + "/LiveOS/initrd" + index + ".img")
         elif not self.base_on:
             logging.error("No initramfs or initrd found for %s" % (version,))
 
@@ -0,0 +1,228 @@
+#
+# metrics.py : Prometheus textfile export of build performance metrics
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Build metrics in the Prometheus text exposition format.
+
+The metrics file is meant for the textfile collector of node-exporter: it
+is replaced atomically, at the end of the build and, optionally, every few
+seconds during it.  Nothing is recorded until open_exporter() is called.
+"""
+
+import os
+import stat
+import time
+import logging
+import threading
+import contextlib
+
+PREFIX = 'livecd_build_'
+
+METRICS = {
+    'info': ('gauge', 'The image being built.'),
+    'success': ('gauge', 'Whether the build completed, 1, or failed, 0.'),
+    'last_update_timestamp_seconds': ('gauge',
+        'When this file was written.'),
+    'phase_duration_seconds': ('gauge', 'Wall clock time of a build phase.'),
+    'download_bytes_total': ('counter', 'Package bytes downloaded.'),
+    'packages': ('gauge', 'Packages installed, by where they were read from.'),
+    'cache_hit_ratio': ('gauge',
+        'Fraction of the installed packages found in the package cache.'),
+    'squash_input_bytes': ('gauge', 'Bytes of data given to mksquashfs.'),
+    'squash_output_bytes': ('gauge', 'Size of the squashfs image.'),
+    'squash_ratio': ('gauge', 'Squashfs image size over its input size.'),
+    'squash_throughput_bytes_per_second': ('gauge',
+        'Input bytes squashed per second.'),
+    'iso_size_bytes': ('gauge', 'Size of the ISO image.'),
+    'subprocesses_total': ('counter',
+        'Commands run through imgcreate.util, by program.'),
+    'subprocess_seconds_total': ('counter',
+        'Run time of the commands run through imgcreate.util, by program.'),
+    'builddir_peak_bytes': ('gauge',
+        'Largest disk usage of the build directory seen.'),
+}
+"""The type and help text of each metric, by name without PREFIX."""
+
+def disk_usage(path):
+    """Return the bytes allocated to the files under path, without crossing
+    into other filesystems."""
+
+    try:
+        dev = os.lstat(path).st_dev
+    except OSError:
+        return 0
+    total = 0
+    for root, dirs, files in os.walk(path, onerror=lambda e: None):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_dev != dev:
+                if name in dirs:
+                    dirs.remove(name)
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                total += st.st_blocks * 512
+    return total
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+                                                              '"', '\\"')
+
+class BuildMetrics(object):
+    """Collect build metrics and write them to a textfile.
+
+    With interval, a background thread rewrites the file every interval
+    seconds, and samples the build directory usage at the same pace.
+    """
+    def __init__(self, path, interval=None):
+        self.path = path
+        self.interval = interval
+        self.builddir = None
+        """The directory whose peak disk usage is recorded."""
+
+        self.__values = {}
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def set(self, metric, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            self.__values.setdefault(metric, {})[key] = value
+
+    def inc(self, metric, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            family = self.__values.setdefault(metric, {})
+            family[key] = family.get(key, 0) + value
+
+    def get(self, metric, **labels):
+        with self.__lock:
+            return self.__values.get(metric, {}).get(
+                tuple(sorted(labels.items())))
+
+    def items(self, metric):
+        """Return the (labels, value) pairs recorded for metric."""
+        with self.__lock:
+            return [(dict(key), value)
+                    for key, value in self.__values.get(metric, {}).items()]
+
+    def sample(self):
+        """Record the build directory usage, if it is a new peak."""
+        if self.builddir is None:
+            return
+        used = disk_usage(self.builddir)
+        if used > (self.get('builddir_peak_bytes') or 0):
+            self.set('builddir_peak_bytes', used)
+
+    def render(self):
+        lines = []
+        with self.__lock:
+            for name in sorted(self.__values):
+                mtype, text = METRICS[name]
+                lines.append('# HELP %s%s %s' % (PREFIX, name, text))
+                lines.append('# TYPE %s%s %s' % (PREFIX, name, mtype))
+                for key, value in sorted(self.__values[name].items()):
+                    labels = ','.join('%s="%s"' % (k, _escape(v))
+                                      for k, v in key)
+                    lines.append('%s%s%s %s' % (PREFIX, name,
+                                 '{%s}' % labels if labels else '',
+                                 repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Replace the metrics file, so that it is never read half written."""
+        self.set('last_update_timestamp_seconds', time.time())
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning("Could not write metrics to '%s': %s" %
+                            (self.path, e))
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.sample()
+            self.write()
+
+    def start(self):
+        if self.interval and self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def close(self, success):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.sample()
+        self.set('success', int(bool(success)))
+        self.write()
+
+
+exporter = None
+"""The BuildMetrics instance set by open_exporter(), or None."""
+
+def open_exporter(path, interval=None, **info):
+    """Record build metrics for the textfile path, rewriting it every
+    interval seconds if interval is given.  info labels the info metric,
+    e.g. with the image name."""
+    global exporter
+
+    exporter = BuildMetrics(path, interval)
+    exporter.set('info', 1, **info)
+    exporter.start()
+    return exporter
+
+def close_exporter(success):
+    """Write the final metrics file."""
+    global exporter
+
+    if exporter is not None:
+        exporter.close(success)
+        exporter = None
+
+def set_value(metric, value, **labels):
+    if exporter is not None:
+        exporter.set(metric, value, **labels)
+
+def inc(metric, value=1, **labels):
+    if exporter is not None:
+        exporter.inc(metric, value, **labels)
+
+def watch_dir(path):
+    """Track the peak disk usage of path, the build directory."""
+    if exporter is not None:
+        exporter.builddir = path
+        exporter.sample()
+
+@contextlib.contextmanager
+def phase(name):
+    """Record the duration of the build phase run in the with block."""
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        if exporter is not None:
+            exporter.set('phase_duration_seconds', time.monotonic() - t0,
+                         phase=name)
+            exporter.sample()
@@ -0,0 +1,209 @@
+#
+# pkgsizes.py : Attribute the size of an image to the packages it holds
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Per-package size reports.
+
+The files present in an install root are attributed to the packages of its
+rpmdb that own them; files no package owns, e.g. those written by %post
+scripts, are attributed to UNPACKAGED.  The compressed size of each file is
+estimated from how well a sample of it compresses, and the estimates are
+then scaled so that they add up to the actual size of the squashfs image.
+"""
+
+import os
+import stat
+import json
+import zlib
+import logging
+
+import rpm
+
+UNPACKAGED = '(unpackaged)'
+
+SAMPLE_SIZE = 64 * 1024
+"""Bytes read from the start of each file to estimate its compressibility."""
+
+def _compressibility(path):
+    try:
+        with open(path, 'rb') as f:
+            sample = f.read(SAMPLE_SIZE)
+    except OSError:
+        return 1.0
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+def _owners(root):
+    """Return a dict mapping the files of the rpmdb in root to the name of
+    their package, and the dict of package sizes to fill in."""
+    owners = {}
+    packages = {}
+    ts = rpm.TransactionSet(root)
+    for h in ts.dbMatch():
+        name = h['name']
+        if not isinstance(name, str):
+            name = name.decode("utf-8")
+        nevra = h['nevra']
+        if not isinstance(nevra, str):
+            nevra = nevra.decode("utf-8")
+        packages[name] = {'name': name, 'nevra': nevra, 'installed': 0,
+                          'estimate': 0.0, 'files': 0}
+        for f in h['filenames']:
+            if not isinstance(f, str):
+                f = f.decode("utf-8")
+            # Files shared by several packages, e.g. across multilib pairs,
+            # are counted for the first one.
+            owners.setdefault(f, name)
+    packages[UNPACKAGED] = {'name': UNPACKAGED, 'nevra': None,
+                            'installed': 0, 'estimate': 0.0, 'files': 0}
+    return owners, packages
+
+def scan(root):
+    """Return the per-package sizes of the regular files under root, a
+    dict by package name of dicts with the keys 'name', 'nevra',
+    'installed' (bytes), 'estimate' (estimated compressed bytes) and
+    'files'.  Hard links are counted once, and other filesystems mounted
+    under root are skipped."""
+
+    owners, packages = _owners(root)
+    dev = os.lstat(root).st_dev
+    # The owner and estimate of each inode, so that a hard link is counted
+    # once, for a package owning one of its paths if there is one.
+    inodes = {}
+    for dirpath, dirs, files in os.walk(root, onerror=lambda e: None):
+        for d in list(dirs):
+            try:
+                if os.lstat(os.path.join(dirpath, d)).st_dev != dev:
+                    dirs.remove(d)
+            except OSError:
+                dirs.remove(d)
+        for name in files:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            owner = owners.get('/' + os.path.relpath(path, root), UNPACKAGED)
+            if st.st_ino in inodes:
+                if inodes[st.st_ino][0] == UNPACKAGED:
+                    inodes[st.st_ino][0] = owner
+                continue
+            estimate = 0.0
+            if st.st_size:
+                estimate = st.st_size * _compressibility(path)
+            inodes[st.st_ino] = [owner, st.st_size, estimate]
+    for owner, size, estimate in inodes.values():
+        pkg = packages[owner]
+        pkg['installed'] += size
+        pkg['estimate'] += estimate
+        pkg['files'] += 1
+    return packages
+
+def load(path):
+    """Return the report saved in path, or None."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def make_report(packages, squashfs_size=None, previous=None):
+    """Return the report of the scan() result packages, with compressed
+    sizes scaled to squashfs_size if given, and the changes since the
+    previous report, if any."""
+
+    estimated = sum(p['estimate'] for p in packages.values())
+    scale = 1.0
+    if squashfs_size and estimated:
+        scale = squashfs_size / estimated
+
+    rows = []
+    for p in packages.values():
+        if not p['files']:
+            continue
+        rows.append({'name': p['name'], 'nevra': p['nevra'],
+                     'installed': p['installed'],
+                     'compressed': int(p['estimate'] * scale),
+                     'files': p['files']})
+    rows.sort(key=lambda r: (-r['compressed'], r['name']))
+
+    report = {'squashfs_bytes': squashfs_size,
+              'installed_bytes': sum(r['installed'] for r in rows),
+              'packages': rows}
+    if previous:
+        report['diff'] = diff(previous, report)
+    return report
+
+def diff(old, new):
+    """Return the changes from report old to report new: the packages
+    added and removed, and the changed ones by decreasing size change."""
+
+    before = dict((r['name'], r) for r in old.get('packages', []))
+    after = dict((r['name'], r) for r in new['packages'])
+    changed = []
+    for name in set(before) | set(after):
+        a = before.get(name, {})
+        b = after.get(name, {})
+        delta = b.get('compressed', 0) - a.get('compressed', 0)
+        if not delta and a.get('nevra') == b.get('nevra'):
+            continue
+        changed.append({'name': name,
+                        'from': (a.get('nevra') or name) if a else None,
+                        'to': (b.get('nevra') or name) if b else None,
+                        'installed_delta': (b.get('installed', 0) -
+                                            a.get('installed', 0)),
+                        'compressed_delta': delta})
+    changed.sort(key=lambda c: (-abs(c['compressed_delta']), c['name']))
+    return {'added': sorted(set(after) - set(before)),
+            'removed': sorted(set(before) - set(after)),
+            'squashfs_delta': ((new['squashfs_bytes'] or 0) -
+                               (old.get('squashfs_bytes') or 0)),
+            'changed': changed}
+
+def write(path, report):
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning("Could not write the package size report '%s': %s" %
+                        (path, e))
+
+def _kib(n):
+    return '%d KiB' % (n // 1024)
+
+def summary(report, count=15):
+    """Return the largest packages, and the largest changes, as text."""
+    lines = ['Largest packages in the image (compressed, installed):']
+    for r in report['packages'][:count]:
+        lines.append('  %12s %12s  %s' % (_kib(r['compressed']),
+                                          _kib(r['installed']), r['name']))
+    changes = report.get('diff')
+    if changes:
+        lines.append('Changes since the previous build: %+d KiB, '
+                     '%d packages added, %d removed' %
+                     (int(changes['squashfs_delta'] / 1024),
+                      len(changes['added']), len(changes['removed'])))
+        for c in changes['changed'][:count]:
+            lines.append('  %+12d KiB  %s: %s -> %s' %
+                         (int(c['compressed_delta'] / 1024), c['name'],
+                          c['from'], c['to']))
+    return '\n'.join(lines)
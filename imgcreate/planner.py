@@ -0,0 +1,192 @@
+#
+# planner.py : Predict image sizes from a resolved package transaction
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import json
+import logging
+
+from imgcreate.errors import *
+
+SIZE_HISTORY = '/var/cache/livecd-tools/size-history.json'
+"""Where the size ratios of finished builds are kept."""
+
+HISTORY_LENGTH = 20
+
+ROOTFS_FACTOR = 1.10
+"""Root filesystem usage over the installed package size, used until
+builds have been recorded: filesystem metadata and %post additions."""
+
+SQUASH_RATIOS = {'xz': 0.33, 'lzma': 0.33, 'zstd': 0.38, 'gzip': 0.42,
+                 'lzo': 0.45, 'lz4': 0.52}
+"""Squashfs image size over the installed package size, by compressor,
+used until builds have been recorded."""
+
+ISO_EXTRA = 100 * 1024 ** 2
+"""Room for the boot files and images next to the squashfs in the ISO."""
+
+def _mib(n):
+    return '%d MiB' % ((n + 1024 ** 2 - 1) // 1024 ** 2)
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def compressor(compress_args):
+    """Return the compressor name of a mksquashfs compress_args string."""
+    if not compress_args:
+        return 'gzip'
+    if compress_args in ('xz1m', 'xz1M'):
+        return 'xz'
+    return compress_args.split()[0]
+
+
+class SizeHistory(object):
+    """The ratios of actual to installed package size of recent builds,
+    stored as JSON in path."""
+
+    def __init__(self, path=SIZE_HISTORY):
+        self.path = path
+        self.data = {'rootfs': [], 'squashfs': {}}
+        try:
+            with open(path) as f:
+                self.data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def rootfs_factor(self):
+        if self.data['rootfs']:
+            return _median(self.data['rootfs'])
+        return ROOTFS_FACTOR
+
+    def squash_ratio(self, compress_args):
+        name = compressor(compress_args)
+        ratios = self.data['squashfs'].get(name)
+        if ratios:
+            return _median(ratios)
+        return SQUASH_RATIOS.get(name, SQUASH_RATIOS['gzip'])
+
+    def record(self, kind, ratio, compress_args=None):
+        """Add a measured ratio, kind being 'rootfs' or 'squashfs', and save
+        the history."""
+        if kind == 'squashfs':
+            ratios = self.data['squashfs'].setdefault(
+                                        compressor(compress_args), [])
+        else:
+            ratios = self.data['rootfs']
+        ratios.append(ratio)
+        del ratios[:-HISTORY_LENGTH]
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.data, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logging.warning("Could not save the size history in '%s': %s" %
+                            (self.path, e))
+
+
+class SizePlan(object):
+    """Predicted sizes of a build, checked against the space it is given.
+
+    installed -- bytes the transaction installs
+    download  -- bytes still to be downloaded into the package cache
+    """
+    def __init__(self, installed, download, history):
+        self.installed = installed
+        self.download = download
+        self.history = history
+
+        self.rootfs = int(installed * history.rootfs_factor())
+        """Predicted bytes used in the root filesystem."""
+
+        self.rootfs_limit = None
+        """Usable bytes of the root filesystem image, if there is one."""
+
+        self.existing = 0
+        """Bytes the root filesystem already holds, e.g. from base_on; they
+        are part of rootfs, but already taken from the free space."""
+
+        self.squashfs = None
+        self.iso = None
+
+        self.fresh = installed > 0
+        """Whether the build starts from an empty root, so that its actual
+        sizes may be recorded in the history."""
+
+        self.needs = {}
+        """Bytes needed at once in each directory, by what they are for."""
+
+    def need(self, path, what, size):
+        self.needs.setdefault(os.path.abspath(path), {})[what] = size
+
+    def growth(self):
+        """Return the bytes the root filesystem is predicted to grow by."""
+        return max(self.rootfs - self.existing, 0)
+
+    def predict_squashfs(self, compress_args):
+        self.squashfs = int(self.installed *
+                            self.history.squash_ratio(compress_args))
+        self.iso = self.squashfs + ISO_EXTRA
+        return self.squashfs
+
+    def report(self):
+        lines = ['Installing %s of packages (%s to download)' %
+                 (_mib(self.installed), _mib(self.download)),
+                 '  root filesystem: %s' % _mib(self.rootfs)]
+        if self.rootfs_limit is not None:
+            lines[-1] += ' of %s' % _mib(self.rootfs_limit)
+        if self.squashfs is not None:
+            lines.append('  squashfs: %s, ISO: %s' % (_mib(self.squashfs),
+                                                      _mib(self.iso)))
+        return '\n'.join(lines)
+
+    def check(self, margin=1.0):
+        """Raise a CreatorError if the predicted sizes, times margin, do not
+        fit the root filesystem image or the free space of the filesystems
+        that are to hold them."""
+
+        problems = []
+        if (self.rootfs_limit is not None and
+            self.rootfs * margin > self.rootfs_limit):
+            problems.append('the root filesystem needs about %s, but the '
+                            'image has %s; raise "part / --size" in the '
+                            'kickstart' % (_mib(self.rootfs * margin),
+                                           _mib(self.rootfs_limit)))
+
+        # Paths on the same filesystem share its free space.
+        byfs = {}
+        for path, items in self.needs.items():
+            probe = path
+            while not os.path.exists(probe):
+                probe = os.path.dirname(probe)
+            st = os.statvfs(probe)
+            dev = os.stat(probe).st_dev
+            entry = byfs.setdefault(dev, [st.f_bavail * st.f_frsize, {}, []])
+            entry[1].update(items)
+            entry[2].append(path)
+        for free, items, paths in byfs.values():
+            total = sum(items.values()) * margin
+            if total > free:
+                problems.append('%s needs about %s (%s), but has %s free' %
+                        (', '.join(sorted(paths)), _mib(total),
+                         ', '.join('%s %s' % (k, _mib(v))
+                                   for k, v in sorted(items.items())),
+                         _mib(free)))
+        if problems:
+            raise CreatorError('The image will not fit:\n  ' +
+                               '\n  '.join(problems))
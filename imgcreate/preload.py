@@ -0,0 +1,238 @@
+#
+# preload.py : Boot-time file preload manifest for live images
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import glob
+import shlex
+import logging
+
+from imgcreate.util import *
+from imgcreate.fs import makedirs
+
+PRELOAD_MANIFEST = 'usr/share/liveos/preload.list'
+"""Location of the manifest, relative to the image root."""
+
+PRELOAD_SERVICE = 'liveos-preload.service'
+
+PRELOAD_READER = 'usr/libexec/liveos-preload'
+
+UNIT_DIRS = ('etc/systemd/system', 'run/systemd/system',
+             'usr/lib/systemd/system', 'lib/systemd/system')
+
+LIB_DIRS = ('usr/lib64', 'lib64', 'usr/lib', 'lib')
+
+_SERVICE = r'''# Installed by livecd-creator: prefetch the boot path files listed in
+# /%(manifest)s while the rest of the boot goes on.
+[Unit]
+Description=Prefetch the boot path of the live image
+DefaultDependencies=no
+ConditionPathExists=/%(manifest)s
+After=local-fs.target
+Before=sysinit.target shutdown.target
+Conflicts=shutdown.target
+
+[Service]
+Type=exec
+ExecStart=/%(reader)s /%(manifest)s %(lanes)d
+'''
+
+_READER = r'''#!/bin/sh
+# Read the files listed in $1 in $2 parallel lanes, so that reads from slow
+# media overlap the rest of the boot.
+
+list=$1
+lanes=${2:-4}
+cd / || exit 0
+i=0
+while [ $i -lt $lanes ]; do
+    (
+        n=0
+        while read -r f; do
+            [ $((n %% lanes)) -eq $i ] && cat -- "$f" > /dev/null 2>&1
+            n=$((n + 1))
+        done < "$list"
+    ) &
+    i=$((i + 1))
+done
+wait
+'''
+
+
+def _find_unit(instroot, name):
+    for d in UNIT_DIRS:
+        path = os.path.join(instroot, d, name)
+        if os.path.lexists(path):
+            return path
+    return None
+
+def _resolve(instroot, path):
+    """Resolve path, which may hold absolute symlinks, inside instroot."""
+
+    for i in range(40):
+        full = os.path.join(instroot, path.lstrip(os.sep))
+        if not os.path.islink(full):
+            return full
+        target = os.readlink(full)
+        if not target.startswith(os.sep):
+            target = os.path.join(os.path.dirname(path), target)
+        path = os.path.normpath(target)
+    return None
+
+def _unit_files(instroot, target):
+    """Return the unit files pulled in by target through .wants/.requires
+    directories and Wants=/Requires= settings, in dependency order."""
+
+    seen, order, queue = set(), [], [target]
+    while queue:
+        name = queue.pop(0)
+        if name in seen:
+            continue
+        seen.add(name)
+        path = _find_unit(instroot, name)
+        if path is None:
+            continue
+        # Aliases such as display-manager.service point at the real unit.
+        real = _resolve(instroot, path[len(instroot):])
+        if real and os.path.isfile(real):
+            order.append(real)
+            with open(real, errors='replace') as f:
+                for line in f:
+                    key, sep, value = line.partition('=')
+                    if key.strip() in ('Wants', 'Requires', 'Upholds'):
+                        queue += value.split()
+        for d in UNIT_DIRS:
+            for kind in ('.wants', '.requires'):
+                depdir = os.path.join(instroot, d, name + kind)
+                if os.path.isdir(depdir):
+                    queue += sorted(os.listdir(depdir))
+    return order
+
+def _exec_paths(unit_file):
+    """Return the programs started by a unit or .desktop file."""
+
+    paths = []
+    with open(unit_file, errors='replace') as f:
+        for line in f:
+            key, sep, value = line.partition('=')
+            if key.strip() in ('ExecStart', 'ExecStartPre', 'Exec'):
+                try:
+                    argv = shlex.split(value)
+                except ValueError:
+                    continue
+                if argv:
+                    paths.append(argv[0].lstrip('-@:+!'))
+    return paths
+
+def _which(instroot, prog):
+    if prog.startswith(os.sep):
+        return _resolve(instroot, prog)
+    for d in ('usr/bin', 'usr/sbin', 'usr/libexec', 'bin', 'sbin'):
+        path = _resolve(instroot, os.path.join(os.sep, d, prog))
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+def _elf_deps(instroot, path, seen):
+    """Append the ELF interpreter and shared libraries of path to seen."""
+
+    out, err, rc = rcall(['readelf', '-dlW', path], raise_err=False)
+    needed = []
+    for line in out.splitlines():
+        if 'Requesting program interpreter:' in line:
+            needed.append(line.split(':', 1)[1].strip(' ]'))
+        elif '(NEEDED)' in line:
+            needed.append(line.rsplit('[', 1)[1].rstrip(']'))
+    for lib in needed:
+        if lib.startswith(os.sep):
+            full = _resolve(instroot, lib)
+        else:
+            full = None
+            for d in LIB_DIRS:
+                full = _resolve(instroot, os.path.join(os.sep, d, lib))
+                if full and os.path.isfile(full):
+                    break
+        if full and os.path.isfile(full) and full not in seen:
+            seen[full] = None
+            _elf_deps(instroot, full, seen)
+
+def boot_path_files(instroot, profile=None):
+    """Return image root relative paths of the files read on the way to the
+    desktop: the units reached from default.target and the programs and
+    libraries they start, the display manager, and the desktop sessions and
+    autostart programs.  Entries of a recorded read profile come first.
+    """
+    seen = {}
+    if profile and os.path.exists(profile):
+        with open(profile) as f:
+            for l in f:
+                full = os.path.join(instroot, l.strip().lstrip(os.sep))
+                if l.strip() and os.path.isfile(full):
+                    seen[full] = None
+
+    programs = []
+    for unit in _unit_files(instroot, 'default.target'):
+        seen[unit] = None
+        programs += _exec_paths(unit)
+    for desktop in sorted(glob.glob(os.path.join(instroot, 'usr', 'share',
+                                                 '*sessions', '*.desktop')) +
+                          glob.glob(os.path.join(instroot, 'etc', 'xdg',
+                                                 'autostart', '*.desktop'))):
+        seen[desktop] = None
+        programs += _exec_paths(desktop)
+
+    for prog in programs:
+        path = _which(instroot, prog)
+        if path and os.path.isfile(path):
+            seen[path] = None
+            _elf_deps(instroot, path, seen)
+
+    return [os.path.relpath(p, instroot) for p in seen]
+
+def write_preload_manifest(instroot, profile=None):
+    """Write the preload manifest into the image and return its length."""
+
+    files = boot_path_files(instroot, profile)
+    manifest = os.path.join(instroot, PRELOAD_MANIFEST)
+    makedirs(os.path.dirname(manifest))
+    with open(manifest, 'w') as f:
+        f.writelines(p + '\n' for p in files)
+    logging.info('Wrote %d entries to preload manifest %s' %
+                 (len(files), manifest))
+    return len(files)
+
+def write_preload_service(instroot, lanes=4):
+    """Install the service that prefetches the manifest at boot.  It is
+    started from sysinit.target in the real root, and runs alongside the
+    rest of the boot until every lane is done."""
+
+    values = {'manifest': PRELOAD_MANIFEST, 'reader': PRELOAD_READER,
+              'lanes': lanes}
+    unitdir = os.path.join(instroot, 'usr/lib/systemd/system')
+    for path, text, mode in ((os.path.join(instroot, PRELOAD_READER),
+                              _READER, 0o755),
+                             (os.path.join(unitdir, PRELOAD_SERVICE),
+                              _SERVICE, 0o644)):
+        makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text % values)
+        os.chmod(path, mode)
+    wants = os.path.join(unitdir, 'sysinit.target.wants')
+    makedirs(wants)
+    link = os.path.join(wants, PRELOAD_SERVICE)
+    if not os.path.lexists(link):
+        os.symlink(os.path.join('..', PRELOAD_SERVICE), link)
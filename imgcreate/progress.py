@@ -0,0 +1,200 @@
+#
+# progress.py : Machine-readable progress events for long-running operations
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Progress events, one JSON object per line.
+
+Each event has the keys:
+
+  time    -- seconds since the epoch
+  event   -- 'begin', 'progress' or 'end'
+  phase   -- the operation, e.g. 'download', 'transaction', 'mirror',
+             'copy', 'squash' or 'iso'
+  unit    -- what done and total count, 'bytes' or 'packages'
+  done    -- units completed so far
+  total   -- units expected in all, or null if unknown
+  elapsed -- seconds since the phase began
+  rate    -- units per second since the phase began
+  eta     -- estimated seconds left, or null if unknown
+
+plus any keys given by the caller.  Events are only written once a
+destination has been set with open_events(); until then, and after a write
+error, reporting is a no-op, so that progress can never fail a build.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+
+class ProgressEvents(object):
+    """Write progress events to a text stream.
+
+    Progress updates of a phase are written at most once per interval
+    seconds; begin and end events are always written.
+    """
+    def __init__(self, stream, interval=0.5):
+        self.stream = stream
+        self.interval = interval
+        self.__phases = {}
+        self.__lock = threading.Lock()
+
+    def __write(self, record):
+        with self.__lock:
+            if self.stream is None:
+                return
+            try:
+                self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+                self.stream.flush()
+            except (OSError, ValueError) as e:
+                logging.warning('Stopped writing progress events: %s' % e)
+                self.stream = None
+
+    def __record(self, event, phase, done, **extra):
+        now = time.time()
+        start, total, unit, last = self.__phases[phase]
+        elapsed = now - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if total is not None and rate > 0:
+            eta = max(total - done, 0) / rate
+        record = {'time': now, 'event': event, 'phase': phase, 'unit': unit,
+                  'done': done, 'total': total, 'elapsed': elapsed,
+                  'rate': rate, 'eta': eta}
+        record.update(extra)
+        return record
+
+    def begin(self, phase, total=None, unit='bytes', **extra):
+        self.__phases[phase] = [time.time(), total, unit, 0.0]
+        self.__write(self.__record('begin', phase, 0, **extra))
+
+    def update(self, phase, done, total=None, **extra):
+        if phase not in self.__phases:
+            self.begin(phase, total)
+        state = self.__phases[phase]
+        if total is not None:
+            state[1] = total
+        now = time.time()
+        if now - state[3] < self.interval:
+            return
+        state[3] = now
+        self.__write(self.__record('progress', phase, done, **extra))
+
+    def end(self, phase, done=None, **extra):
+        if phase not in self.__phases:
+            return
+        if done is None:
+            done = self.__phases[phase][1] or 0
+        self.__write(self.__record('end', phase, done, **extra))
+        del self.__phases[phase]
+
+    def close(self):
+        with self.__lock:
+            if self.stream not in (None, sys.stdout, sys.stderr):
+                self.stream.close()
+            self.stream = None
+
+
+events = None
+"""The ProgressEvents instance set by open_events(), or None."""
+
+def open_events(target, interval=0.5):
+    """Send progress events to target: a file descriptor number, 'unix:PATH'
+    for a Unix stream socket, 'tcp:HOST:PORT', or a file path to append to.
+    """
+    global events
+
+    target = str(target)
+    if target.isdigit():
+        stream = os.fdopen(int(target), 'w', buffering=1)
+    elif target.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[5:])
+        stream = sock.makefile('w', buffering=1)
+        sock.close()
+    elif target.startswith('tcp:'):
+        host, port = target[4:].rsplit(':', 1)
+        sock = socket.create_connection((host.strip('[]'), int(port)))
+        stream = sock.makefile('w', buffering=1)
+        sock.close()
+    else:
+        stream = open(target, 'a', buffering=1)
+    events = ProgressEvents(stream, interval)
+    return events
+
+def close_events():
+    global events
+
+    if events is not None:
+        events.close()
+        events = None
+
+def begin(phase, total=None, unit='bytes', **extra):
+    """Report the start of phase, which is to do total units of work."""
+    if events is not None:
+        events.begin(phase, total, unit, **extra)
+
+def update(phase, done, total=None, **extra):
+    """Report that done units of phase are complete."""
+    if events is not None:
+        events.update(phase, done, total, **extra)
+
+def end(phase, done=None, **extra):
+    """Report the end of phase, after done units (default: its total)."""
+    if events is not None:
+        events.end(phase, done, **extra)
+
+
+class FileGrowth(object):
+    """Report the size of a file being written by another process as the
+    progress of phase, from a background thread, while in a with block."""
+
+    def __init__(self, phase, path, total=None, interval=1.0, **extra):
+        self.phase = phase
+        self.path = path
+        self.total = total
+        self.interval = interval
+        self.extra = extra
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __size(self):
+        try:
+            return os.stat(self.path).st_size
+        except OSError:
+            return 0
+
+    def __watch(self):
+        while not self.__stop.wait(self.interval):
+            update(self.phase, self.__size(), self.total)
+
+    def __enter__(self):
+        begin(self.phase, self.total, **self.extra)
+        if events is not None:
+            self.__thread = threading.Thread(target=self.__watch, daemon=True)
+            self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        end(self.phase, self.__size(), ok=exc_type is None)
+        return False
@@ -0,0 +1,204 @@
+#
+# pxe.py : Export a LiveOS image for network booting
+#
+# Copyright 2026, Fedora Project
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""PXE boot trees of LiveOS images.
+
+By default squashfs.img is appended to the initrd as a cpio archive of its
+own, which the kernel unpacks next to the initramfs, and dracut boots with
+root=live:/squashfs.img.  As squashfs.img is compressed already, the
+archive is stored as is, unless zstd or gzip is asked for; both are run on
+all CPUs, with zstd and pigz.  With a live URL, squashfs.img is written
+next to the kernel to be served over HTTP, the initrd is left as it is,
+and dracut's livenet module fetches the image at boot.
+"""
+
+import os
+import re
+import shutil
+import logging
+import subprocess
+
+from imgcreate.errors import *
+from imgcreate.fs import makedirs
+
+COMPRESSORS = ('none', 'zstd', 'gzip')
+
+BOOT_DIRS = ('images/pxeboot', 'isolinux', 'syslinux')
+
+PXELINUX_DIRS = ('/usr/share/syslinux', '/usr/lib/syslinux')
+
+IMAGE_NAME = 'squashfs.img'
+"""Name of the squashfs image in the PXE tree, and in the initramfs."""
+
+_CPIO_MAX = 0xffffffff
+"""The largest file a newc cpio archive holds."""
+
+# Boot arguments of the ISO that do not apply over the network.
+_DROP_ARGS = re.compile(r'^(root|rootfstype|rootflags|initrd)=|'
+                        r'^rd\.live\.check$')
+
+def find_boot_files(isodir):
+    """Return the paths of the first kernel and initrd of the LiveOS tree
+    isodir, e.g. a mounted ISO."""
+    for d in BOOT_DIRS:
+        for kernel, initrd in (('vmlinuz0', 'initrd0.img'),
+                               ('vmlinuz', 'initrd.img')):
+            kernel = os.path.join(isodir, d, kernel)
+            initrd = os.path.join(isodir, d, initrd)
+            if os.path.isfile(kernel) and os.path.isfile(initrd):
+                return kernel, initrd
+    raise CreatorError("No kernel and initrd found in '%s'; is it a LiveOS "
+                       "image?" % isodir)
+
+def find_squashfs(isodir):
+    for path in ('LiveOS/squashfs.img', 'squashfs.img'):
+        if os.path.isfile(os.path.join(isodir, path)):
+            return os.path.join(isodir, path)
+    raise CreatorError("No squashfs.img found in '%s'" % isodir)
+
+def kernel_args(isodir):
+    """Return the kernel arguments of the first boot entry of isodir, less
+    those naming the boot media."""
+    for cfg, pattern in (('isolinux/isolinux.cfg', r'^\s*append\s+(.*)$'),
+                         ('syslinux/syslinux.cfg', r'^\s*append\s+(.*)$'),
+                         ('EFI/BOOT/grub.cfg',
+                          r'^\s*linux(?:efi)?\s+\S+\s+(.*)$'),
+                         ('boot/grub2/grub.cfg',
+                          r'^\s*linux(?:efi)?\s+\S+\s+(.*)$')):
+        try:
+            with open(os.path.join(isodir, cfg)) as f:
+                text = f.read()
+        except OSError:
+            continue
+        m = re.search(pattern, text, re.M)
+        if m:
+            return [a for a in m.group(1).split() if not _DROP_ARGS.match(a)]
+    return ['rd.live.image']
+
+def _cpio_header(name, mode, size, mtime, ino):
+    namesize = len(name) + 1
+    header = ('070701' + '%08x' * 13) % (ino, mode, 0, 0, 1, int(mtime),
+                                         size, 0, 0, 0, 0, namesize, 0)
+    data = header.encode('ascii') + name.encode('utf-8') + b'\0'
+    return data + b'\0' * (-len(data) % 4)
+
+def write_cpio(out, path, name=IMAGE_NAME, bufsize=4 * 1024 ** 2):
+    """Write a newc cpio archive of the file path, named name, to the file
+    object out."""
+    st = os.stat(path)
+    if st.st_size > _CPIO_MAX:
+        raise CreatorError("'%s' is %d bytes, more than a cpio archive can "
+                           "hold; serve it with a live URL instead" %
+                           (path, st.st_size))
+    out.write(_cpio_header(name, 0o100644, st.st_size, st.st_mtime, 1))
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, out, bufsize)
+    out.write(b'\0' * (-st.st_size % 4))
+    out.write(_cpio_header('TRAILER!!!', 0, 0, 0, 0))
+
+def _compress_command(compress, threads):
+    if compress == 'zstd':
+        if not shutil.which('zstd'):
+            raise CreatorError("zstd is needed to compress the initrd")
+        return ['zstd', '-q', '-c', '-T%d' % threads]
+    if shutil.which('pigz'):
+        args = ['pigz', '-c']
+        if threads:
+            args += ['-p', str(threads)]
+        return args
+    logging.warning('pigz not installed; compressing the initrd with gzip '
+                    'on a single CPU')
+    return ['gzip', '-c']
+
+def append_image(initrd, image, output, compress='none', threads=0):
+    """Write initrd followed by a cpio archive of image to output,
+    compressed with compress, one of COMPRESSORS, on threads CPUs, 0 being
+    all of them."""
+
+    if compress not in COMPRESSORS:
+        raise CreatorError("Unknown initrd compression '%s'" % compress)
+    with open(output, 'wb') as out:
+        with open(initrd, 'rb') as f:
+            shutil.copyfileobj(f, out, 4 * 1024 ** 2)
+        # The kernel skips the zero padding between concatenated archives,
+        # which must each start on a 4 byte boundary.
+        out.write(b'\0' * (-out.tell() % 4))
+        if compress == 'none':
+            write_cpio(out, image)
+            return
+        out.flush()
+        p = subprocess.Popen(_compress_command(compress, threads),
+                             stdin=subprocess.PIPE, stdout=out)
+        try:
+            write_cpio(p.stdin, image)
+        finally:
+            p.stdin.close()
+            rc = p.wait()
+        if rc != 0:
+            raise CreatorError("Failed to compress the image appended to "
+                               "the initrd")
+
+def _copy_pxelinux(outdir):
+    for d in PXELINUX_DIRS:
+        if os.path.isfile(os.path.join(d, 'pxelinux.0')):
+            for f in ('pxelinux.0', 'ldlinux.c32'):
+                if os.path.isfile(os.path.join(d, f)):
+                    shutil.copy2(os.path.join(d, f), outdir)
+            return True
+    logging.warning('pxelinux.0 not found; add it to %s, or make sure '
+                    'syslinux is installed' % outdir)
+    return False
+
+def export(isodir, outdir, compress='none', live_url=None, threads=0):
+    """Write the PXE boot tree of the LiveOS tree isodir to outdir: the
+    kernel, the initrd, pxelinux and its configuration, and, with a
+    live_url, the squashfs image to be served from it."""
+
+    kernel, initrd = find_boot_files(isodir)
+    image = find_squashfs(isodir)
+    args = kernel_args(isodir)
+    makedirs(outdir)
+
+    shutil.copy2(kernel, outdir)
+    if live_url:
+        shutil.copy2(initrd, outdir)
+        shutil.copy2(image, os.path.join(outdir, IMAGE_NAME))
+        root = 'live:%s/%s' % (live_url.rstrip('/'), IMAGE_NAME)
+        logging.info('Serve %s at %s; the initrd needs the dracut livenet '
+                     'module' % (os.path.join(outdir, IMAGE_NAME),
+                                 root[len('live:'):]))
+    else:
+        append_image(initrd, image,
+                     os.path.join(outdir, os.path.basename(initrd)),
+                     compress, threads)
+        root = 'live:/' + IMAGE_NAME
+    _copy_pxelinux(outdir)
+
+    if 'rd.live.image' not in args:
+        args.append('rd.live.image')
+    makedirs(os.path.join(outdir, 'pxelinux.cfg'))
+    with open(os.path.join(outdir, 'pxelinux.cfg', 'default'), 'w') as f:
+        f.write('DEFAULT pxeboot\n'
+                'TIMEOUT 20\n'
+                'PROMPT 0\n'
+                'LABEL pxeboot\n'
+                '\tKERNEL %s\n'
+                '\tAPPEND initrd=%s root=%s %s\n'
+                'ONERROR LOCALBOOT 0\n' %
+                (os.path.basename(kernel), os.path.basename(initrd), root,
+                 ' '.join(args)))
@@ -17,41 +17,128 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import os
+import time
+import selectors
 import subprocess
+import collections
 import logging
-import io
 from imgcreate.errors import *
+from imgcreate import metrics
+
+ProcessResult = collections.namedtuple('ProcessResult',
+                                       'returncode out err elapsed dropped')
+"""The outcome of run(): the exit status, the retained stdout and stderr
+text, the run time in seconds, and the number of lines dropped from the
+retained output."""
+
+def run(args, stdin=None, cwd=None, env=None, keep=1000, merge=False,
+        log=logging.debug, **kwargs):
+    """Run a command, reading its stdout and stderr as they are written.
+
+    Each line is passed to log, with the seconds since the start and the
+    program name, as soon as it arrives, so neither a chatty command can
+    fill a pipe and stall, nor a long one stay silent until it exits.  Only
+    the last keep lines of each stream are retained (all of them if keep is
+    None).  stdin, if not None, is a string fed to the command.  With merge,
+    stderr is read as part of stdout.  Other keyword arguments are passed
+    to subprocess.Popen().  Return a ProcessResult.
+    """
+    prog = os.path.basename(str(args[0] if isinstance(args, (list, tuple))
+                                else args).split()[0])
+    t0 = time.monotonic()
+    p = subprocess.Popen(args, cwd=cwd, env=env,
+                         stdin=None if stdin is None else subprocess.PIPE,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT if merge else subprocess.PIPE,
+                         **kwargs)
+    lines = {p.stdout: collections.deque(maxlen=keep)}
+    if not merge:
+        lines[p.stderr] = collections.deque(maxlen=keep)
+    partial = dict((f, b'') for f in lines)
+    counts = dict((f, 0) for f in lines)
+
+    def emit(f, line):
+        text = line.decode('utf-8', 'replace')
+        lines[f].append(text)
+        counts[f] += 1
+        if log:
+            # Keep only the last state of \r-updated progress lines.
+            log('[%8.3f] %s: %s', time.monotonic() - t0, prog,
+                text.rstrip('\n').rsplit('\r', 1)[-1])
+
+    sel = selectors.DefaultSelector()
+    try:
+        for f in lines:
+            sel.register(f, selectors.EVENT_READ)
+        data = b''
+        if stdin is not None:
+            data = stdin.encode('utf-8')
+            if data:
+                os.set_blocking(p.stdin.fileno(), False)
+                sel.register(p.stdin, selectors.EVENT_WRITE)
+            else:
+                p.stdin.close()
+        while sel.get_map():
+            for key, events in sel.select():
+                f = key.fileobj
+                if f is p.stdin:
+                    try:
+                        n = os.write(f.fileno(), data[:65536])
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        n = len(data)
+                    data = data[n:]
+                    if not data:
+                        sel.unregister(f)
+                        f.close()
+                    continue
+                chunk = os.read(f.fileno(), 65536)
+                if not chunk:
+                    sel.unregister(f)
+                    if partial[f]:
+                        emit(f, partial[f])
+                    continue
+                buf = partial[f] + chunk
+                *complete, partial[f] = buf.split(b'\n')
+                for line in complete:
+                    emit(f, line + b'\n')
+    finally:
+        sel.close()
+        for f in (p.stdin, p.stdout, p.stderr):
+            if f:
+                f.close()
+        rc = p.wait()
+    elapsed = time.monotonic() - t0
+    logging.debug('%s exited with %d after %.3f seconds', prog, rc, elapsed)
+    metrics.inc('subprocesses_total', program=prog)
+    metrics.inc('subprocess_seconds_total', elapsed, program=prog)
+
+    out = ''.join(lines[p.stdout])
+    err = '' if merge else ''.join(lines[p.stderr])
+    dropped = sum(counts[f] - len(lines[f]) for f in lines)
+    return ProcessResult(rc, out, err, elapsed, dropped)
 
 def call(*popenargs, **kwargs):
     """
         Calls subprocess.Popen() with the provided arguments.  All stdout and
-        stderr output is sent to logging.debug().  The return value is the exit
-        code of the command.
+        stderr output is sent to logging.debug() as it is written.  The return
+        value is the exit code of the command.
     """
-    p = subprocess.Popen(*popenargs, stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT, **kwargs)
-    rc = p.wait()
-    fp = io.open(p.stdout.fileno(), mode="r", encoding="utf-8", closefd=False)
-    stdout = fp.read().splitlines(keepends=False)
-    fp.close()
-
-    # Log output using logging module
-    for buf in stdout:
-        logging.debug("%s", buf)
-
-    return rc
+    return run(*popenargs, merge=True, keep=0, **kwargs).returncode
 
 def rcall(args, stdin='', raise_err=True, cwd=None, env=None):
     """Return stdout, stderr, & returncode from a subprocess call.
     """
-    out, err, p, environ = '', '', None, None
+    out, err, rc, environ = '', '', None, None
     if env is not None:
         environ = os.environ.copy()
         environ.update(env)
     try:
-        p = subprocess.Popen(args, stdin=subprocess.PIPE, cwd=cwd, env=environ,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = p.communicate(stdin.encode('utf-8'))
+        # The output is parsed by the callers, so it is all kept.
+        rc, out, err = run(args, stdin=stdin, cwd=cwd, env=environ,
+                           keep=None, log=None)[:3]
     except OSError as e:
         err = 'Failed executing:\n%s\nerror: %s' % (args, e)
         if raise_err:
@@ -63,9 +150,9 @@ def rcall(args, stdin='', raise_err=True, cwd=None, env=None):
                                 'error: %s\nstdout: %s\nstderr: %s' %
                                (args, e, out, err))
     else:
-        if p.returncode != 0 and raise_err:
+        if rc != 0 and raise_err:
             raise CreatorError('Error in call:\n%s\nenviron: %s\n'
                                 'stdout: %s\nstderr: %s\nreturncode: %s' %
-                               (args, environ, out, err, p.returncode))
+                               (args, environ, out, err, rc))
     finally:
-        return out.decode('utf-8'), err.decode('utf-8'), p.returncode
+        return out, err, rc